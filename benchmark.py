@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for Local Directory Server internals.
+Measures the listing engine against the original listdir + stat implementation,
+and file download throughput with and without sendfile.
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import socket
+import statistics
+import tempfile
+import threading
+import time
+from datetime import datetime
+from http.client import HTTPConnection
+
+import directory_server
+
+
+def legacy_read_directory(path: str) -> list:
+    """The original listing loop: os.listdir plus os.stat, isdir and islink per entry."""
+    files = []
+    for name in os.listdir(path):
+        fullname = os.path.join(path, name)
+        try:
+            stat_info = os.stat(fullname)
+            modified_timestamp = stat_info.st_mtime
+            modified_iso = datetime.fromtimestamp(modified_timestamp).isoformat()
+            size_bytes = stat_info.st_size
+        except OSError:
+            modified_timestamp = 0
+            modified_iso = None
+            size_bytes = 0
+
+        file_type = "file"
+        if os.path.isdir(fullname):
+            file_type = "directory"
+        elif os.path.islink(fullname):
+            file_type = "symlink"
+
+        _, extension = os.path.splitext(name)
+        extension = extension.lstrip('.').lower() if extension else None
+
+        files.append({
+            "name": name,
+            "extension": extension,
+            "type": file_type,
+            "size_bytes": size_bytes,
+            "modified_timestamp": modified_timestamp,
+            "modified_iso": modified_iso
+        })
+
+    files.sort(key=lambda x: x["modified_timestamp"], reverse=True)
+    return files
+
+
+class CallCounter:
+    """
+    Counts filesystem calls made through the os module while active.
+    Nested calls (os.path.isdir calling os.stat) are only counted once.
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self._local = threading.local()
+        self._originals = []
+
+    def _wrap(self, owner, attr, label):
+        original = getattr(owner, attr)
+        counter = self
+
+        def wrapper(*args, **kwargs):
+            depth = getattr(counter._local, "depth", 0)
+            if depth == 0:
+                counter.counts[label] = counter.counts.get(label, 0) + 1
+            counter._local.depth = depth + 1
+            try:
+                result = original(*args, **kwargs)
+            finally:
+                counter._local.depth = depth
+            if attr == "scandir":
+                return CountingScandir(result, counter)
+            return result
+
+        self._originals.append((owner, attr, original))
+        setattr(owner, attr, wrapper)
+
+    def __enter__(self):
+        self._wrap(os, "listdir", "os.listdir")
+        self._wrap(os, "scandir", "os.scandir")
+        self._wrap(os, "stat", "os.stat")
+        self._wrap(os, "lstat", "os.lstat")
+        self._wrap(os.path, "isdir", "os.path.isdir")
+        self._wrap(os.path, "islink", "os.path.islink")
+        return self
+
+    def __exit__(self, *exc):
+        for owner, attr, original in reversed(self._originals):
+            setattr(owner, attr, original)
+        self._originals.clear()
+
+
+class CountingScandir:
+    """Wraps a scandir iterator so DirEntry.stat() calls can be counted."""
+
+    def __init__(self, iterator, counter):
+        self._iterator = iterator
+        self._counter = counter
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._iterator.close()
+
+    def __iter__(self):
+        for entry in self._iterator:
+            yield CountingDirEntry(entry, self._counter)
+
+
+class CountingDirEntry:
+    """
+    DirEntry proxy. stat() is counted once per entry because DirEntry caches
+    it; is_dir()/is_symlink() are answered from the directory read itself.
+    """
+
+    def __init__(self, entry, counter):
+        self._entry = entry
+        self._counter = counter
+        self._stat_counted = False
+        self.name = entry.name
+        self.path = entry.path
+
+    def stat(self, **kwargs):
+        if not self._stat_counted:
+            self._stat_counted = True
+            counts = self._counter.counts
+            counts["DirEntry.stat"] = counts.get("DirEntry.stat", 0) + 1
+        return self._entry.stat(**kwargs)
+
+    def is_dir(self, **kwargs):
+        return self._entry.is_dir(**kwargs)
+
+    def is_symlink(self):
+        return self._entry.is_symlink()
+
+
+def make_fixture(root: str, entries: int) -> None:
+    """Create a folder with a mix of files and sub-folders."""
+    for i in range(entries):
+        if i % 20 == 0:
+            os.mkdir(os.path.join(root, f"folder_{i:05d}"))
+        else:
+            with open(os.path.join(root, f"lesson_{i:05d}.ppsx"), "wb") as f:
+                f.write(b"x" * (i % 512))
+
+
+def time_engine(fn, path: str, repeat: int) -> list:
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(path)
+        durations.append((time.perf_counter() - start) * 1000)
+    return durations
+
+
+def bench_listing(args) -> None:
+    owns_fixture = args.dir is None
+    path = args.dir or tempfile.mkdtemp(prefix="listing_bench_")
+    try:
+        if owns_fixture:
+            make_fixture(path, args.entries)
+        entry_count = len(os.listdir(path))
+
+        engines = [
+            ("listdir + stat/isdir/islink", legacy_read_directory),
+            ("scandir single pass", directory_server.read_directory),
+        ]
+
+        print(f"\n{'='*60}")
+        print(f"Listing Benchmark: {path}")
+        print(f"Entries: {entry_count} | Repeat: {args.repeat}")
+        print(f"{'='*60}")
+
+        for label, fn in engines:
+            with CallCounter() as counter:
+                fn(path)
+            durations = time_engine(fn, path, args.repeat)
+            calls = sum(counter.counts.values())
+
+            print(f"\n{label}")
+            print(f"  Filesystem calls:   {calls} ({calls / max(entry_count, 1):.2f} per entry)")
+            for name, count in sorted(counter.counts.items()):
+                print(f"    {name:<18}{count}")
+            print(f"  Median time:        {statistics.median(durations):.2f}ms")
+            print(f"  Per 1k entries:     {statistics.median(durations) * 1000 / max(entry_count, 1):.2f}ms")
+
+        print(f"{'='*60}\n")
+    finally:
+        if owns_fixture:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(root: str, mode: str, use_sendfile: bool) -> int:
+    """Start a plain-HTTP server for root in a background thread; returns its port."""
+    port = free_port()
+    if mode == "asyncio":
+        server = directory_server.AsyncDirectoryServer(("127.0.0.1", port), root)
+        server.use_sendfile = use_sendfile
+    else:
+        handler = type("BenchHandler", (directory_server.DirectoryHandler,), {
+            "use_sendfile": use_sendfile,
+            "__init__": lambda self, *a, **kw: directory_server.DirectoryHandler.__init__(self, *a, directory=root, **kw),
+        })
+        server = directory_server.ThreadedHTTPServer(("127.0.0.1", port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    for _ in range(50):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    return port
+
+
+def download(port: int, path: str, range_header: str = None) -> int:
+    conn = HTTPConnection("127.0.0.1", port, timeout=60)
+    headers = {"Range": range_header} if range_header else {}
+    conn.request("GET", path, headers=headers)
+    response = conn.getresponse()
+    received = 0
+    while True:
+        chunk = response.read(1024 * 1024)
+        if not chunk:
+            break
+        received += len(chunk)
+    conn.close()
+    return received
+
+
+def bench_sendfile(args) -> None:
+    # Keep per-request access log lines out of the results
+    directory_server.logger.setLevel(logging.WARNING)
+    root = tempfile.mkdtemp(prefix="sendfile_bench_")
+    try:
+        size = int(args.size_mb * 1024 * 1024)
+        with open(os.path.join(root, "video.mp4"), "wb") as f:
+            block = os.urandom(1024 * 1024)
+            for _ in range(size // len(block)):
+                f.write(block)
+            f.write(block[:size % len(block)])
+
+        half = size // 2
+        print(f"\n{'='*60}")
+        print(f"Download Throughput Benchmark (plain HTTP, localhost)")
+        print(f"File: {args.size_mb} MB | Repeat: {args.repeat}")
+        print(f"sendfile available: {hasattr(os, 'sendfile')}")
+        print(f"{'='*60}")
+
+        for mode in ("threaded", "asyncio"):
+            for use_sendfile in (False, True):
+                port = start_server(root, mode, use_sendfile)
+                label = f"{mode}, {'sendfile' if use_sendfile else 'buffered copy'}"
+                for what, range_header, expected in (("whole file", None, size),
+                                                     ("range (second half)", f"bytes={half}-", size - half)):
+                    rates = []
+                    for _ in range(args.repeat):
+                        start = time.perf_counter()
+                        received = download(port, "/video.mp4", range_header)
+                        elapsed = time.perf_counter() - start
+                        if received != expected:
+                            raise RuntimeError(f"{label}: received {received} bytes, expected {expected}")
+                        rates.append(received / elapsed / (1024 * 1024))
+                    print(f"  {label + ', ' + what:<46}{statistics.median(rates):>8.0f} MB/s")
+
+        print(f"{'='*60}\n")
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for Local Directory Server")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    listing = subparsers.add_parser("listing", help="Compare directory listing engines")
+    listing.add_argument("-n", "--entries", type=int, default=1000,
+                         help="Entries in the generated test folder (default: 1000)")
+    listing.add_argument("-r", "--repeat", type=int, default=20,
+                         help="Timed runs per engine (default: 20)")
+    listing.add_argument("-d", "--dir", type=str, default=None,
+                         help="Benchmark an existing folder instead of a generated one")
+    listing.set_defaults(func=bench_listing)
+
+    sendfile = subparsers.add_parser("sendfile", help="Compare download throughput with and without sendfile")
+    sendfile.add_argument("-s", "--size-mb", type=float, default=256,
+                          help="Size of the generated test file in MB (default: 256)")
+    sendfile.add_argument("-r", "--repeat", type=int, default=3,
+                          help="Downloads per configuration (default: 3)")
+    sendfile.set_defaults(func=bench_sendfile)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
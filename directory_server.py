@@ -8,14 +8,35 @@ Includes CORS and HTTPS support.
 import os
 import sys
 import json
+import hashlib
+import base64
+import gzip
+import zlib
 import urllib.parse
 import subprocess
 import time
 import logging
-from http.server import SimpleHTTPRequestHandler, HTTPServer
+import threading
+import weakref
+import shutil
+import secrets
+import email.utils
+import html
+import mimetypes
+import posixpath
+import ssl
+import queue
+import asyncio
+import http.client
+import heapq
+import bisect
+from collections import OrderedDict, deque
+from http import HTTPStatus
+from http.server import SimpleHTTPRequestHandler, HTTPServer, DEFAULT_ERROR_MESSAGE, DEFAULT_ERROR_CONTENT_TYPE
 from socketserver import ThreadingMixIn
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from datetime import datetime
+from datetime import datetime, timezone
 from pathlib import Path
 
 DEFAULT_PORT = 8000
@@ -23,10 +44,122 @@ GOOGLE_DRIVE_PROCESS_NAMES = ["GoogleDriveFS.exe", "GoogleDriveSync.exe", "Googl
 MAX_RETRIES = 10
 RETRY_INTERVAL_SECONDS = 60
 
+# Range requests: more ranges than this (after merging) are answered with the whole file
+MAX_RANGES_PER_REQUEST = 32
+COPY_BUFFER_SIZE = 64 * 1024
+
+# HTTP/1.1 keep-alive
+DEFAULT_KEEP_ALIVE_TIMEOUT_SECONDS = 5
+DEFAULT_KEEP_ALIVE_MAX_REQUESTS = 100
+
+# In-memory cache of popular file contents (disabled by default)
+DEFAULT_HOT_CACHE_MB = 0
+DEFAULT_HOT_CACHE_MAX_FILE_MB = 256
+# A file is only loaded into memory on its second request within the
+# recently-seen window, so one-off downloads don't evict the lesson files
+HOT_CACHE_ADMIT_AFTER = 2
+HOT_CACHE_SEEN_WINDOW = 4096
+HOT_CACHE_WRITE_SIZE = 256 * 1024
+
+# Pre-compressed .gz copies of compressible files, kept on local disk
+# (disabled by default). Smaller files aren't worth it, and a copy is only
+# kept if it saves at least GZIP_CACHE_MIN_SAVING of the file's size.
+DEFAULT_GZIP_CACHE_MB = 0
+GZIP_CACHE_MIN_BYTES = 8 * 1024
+GZIP_CACHE_MAX_FILE_MB = 256
+GZIP_CACHE_MIN_SAVING = 0.1
+GZIP_CACHE_QUEUE_SIZE = 1024
+GZIP_COMPRESSIBLE_EXTENSIONS = {
+    '.pdf', '.svg', '.html', '.htm', '.json', '.txt', '.vtt', '.srt', '.css', '.js', '.xml', '.csv'
+}
+
+# Worker pool server
+DEFAULT_POOL_WORKERS = 32
+DEFAULT_POOL_QUEUE_SIZE = 256
+TLS_HANDSHAKE_TIMEOUT_SECONDS = 10
+# TLS session resumption: the server context (and with it OpenSSL's session
+# ticket keys and session cache) is rebuilt this often
+DEFAULT_TLS_TICKET_ROTATION_SECONDS = 3600
+TLS_TICKETS_PER_HANDSHAKE = 2
+# How often the --cert/--key files are checked for a renewed certificate
+DEFAULT_CERT_CHECK_SECONDS = 60
+# Linux kernel TLS: getsockopt(SOL_TLS, TLS_TX) only succeeds once the kernel
+# holds the connection's transmit keys
+SOL_TLS = 282
+TLS_TX = 1
+# How long a connection may take to send its request line and headers, so
+# clients that connect and never send anything don't hold a worker forever
+REQUEST_READ_TIMEOUT_SECONDS = 30
+
+# Reserved request paths that are answered by the server itself
+STATS_PATH = "/_stats"
+# Search over the tree index (needs --index)
+SEARCH_PATH = "/_search"
+DEFAULT_SEARCH_LIMIT = 100
+MAX_SEARCH_LIMIT = 1000
+# Several listings in one request: /_batch?path=/a/&path=/b/
+BATCH_PATH = "/_batch"
+MAX_BATCH_PATHS = 50
+BATCH_WORKERS = 8
+# Server-Sent Events change feed: /_events?path=/folder/. Needs the tree
+# index. Recent events are kept for clients reconnecting with
+# Last-Event-ID; idle streams get a comment line every heartbeat so dead
+# connections are noticed.
+EVENTS_PATH = "/_events"
+EVENTS_BACKLOG = 1000
+EVENTS_HEARTBEAT_SECONDS = 15
+EVENTS_RETRY_MS = 5000
+MAX_EVENT_SUBSCRIBERS = 1000
+# Events queued for one slow client before it is told to re-sync instead
+MAX_EVENTS_QUEUED = 1000
+# Bits in each folder's trigram signature (see SearchSummary)
+SEARCH_SIGNATURE_BITS = 2048
+
+# Directory listing cache
+DEFAULT_LISTING_CACHE_MB = 64
+DEFAULT_LISTING_MAX_AGE_SECONDS = 30
+
+# Recursive listings (?depth=N): deepest level, most entries (the tree is cut
+# off and marked truncated after this many) and largest encoded body
+MAX_TREE_DEPTH = 8
+MAX_TREE_ENTRIES = 20000
+MAX_TREE_BYTES = 16 * 1024 * 1024
+
+# Paged listings (?limit=N&cursor=...): largest page, and how many encoded
+# pages are kept with each cached listing
+MAX_LISTING_LIMIT = 1000
+MAX_LISTING_VIEWS = 32
+
+# Delta listings (?since=): superseded versions of a folder's listing kept
+# per folder, and entries kept across all folders' old versions
+DELTA_HISTORY_VERSIONS = 16
+DELTA_HISTORY_ENTRIES = 200000
+
+# Streamed listings (?format=ndjson) are sent in chunks of about this size;
+# the first entry goes out on its own
+NDJSON_CHUNK_BYTES = 16 * 1024
+
+# JSON responses are gzip/deflate compressed for clients that accept it.
+# Smaller bodies aren't worth it; listing bodies are compressed once per
+# folder version and kept with the listing.
+MIN_COMPRESS_BYTES = 1024
+COMPRESS_LEVEL = 6
+
+# Whole-tree metadata index: seconds between background refresh passes, and
+# the age after which a directory is re-read even if its mtime is unchanged
+# (catches files rewritten in place)
+DEFAULT_INDEX_INTERVAL_SECONDS = 30
+INDEX_RESCAN_AGE_SECONDS = 600
+# The index is saved at most this often (and at shutdown) when it changed
+INDEX_SNAPSHOT_INTERVAL_SECONDS = 300
+INDEX_SNAPSHOT_VERSION = 1
+
 # Setup logging
 LOG_DIR = Path.home() / "directory_server_logs"
 LOG_DIR.mkdir(exist_ok=True)
 LOG_FILE = LOG_DIR / f"directory_server_{datetime.now().strftime('%Y%m%d')}.log"
+INDEX_SNAPSHOT_FILE = LOG_DIR / "tree_index.json"
+GZIP_CACHE_DIR = Path.home() / "directory_server_cache" / "gzip"
 
 logging.basicConfig(
     level=logging.INFO,
@@ -105,175 +238,3352 @@ def wait_for_google_drive():
     return False
 
 
-class DirectoryHandler(SimpleHTTPRequestHandler):
-    def log_message(self, format, *args):
-        """Override to use our logger."""
-        logger.info("%s - %s" % (self.address_string(), format % args))
-    
-    def end_headers(self):
-        """Add CORS headers and Content-Disposition to every response."""
-        self.send_header("Access-Control-Allow-Origin", "*")
-        self.send_header("Access-Control-Allow-Methods", "GET, OPTIONS")
-        self.send_header("Access-Control-Allow-Headers", "Range")
-        self.send_header("Access-Control-Max-Age", "86400")
-        
-        # Check if we should force download for this file path
-        path = self.path.split('?')[0]
-        _, ext = os.path.splitext(path)
-        ext = ext.lower()
-        
-        # Force download for PowerPoint files (Chrome doesn't handle them well natively)
-        force_download_extensions = {'.ppsx', '.pptx', '.ppt', '.pps'}
-        
-        if ext in force_download_extensions:
-            filename = os.path.basename(path)
-            # Simple quote handling
-            filename = filename.replace('"', '\\"')
-            self.send_header("Content-Disposition", f'attachment; filename="{filename}"')
-            
-        super().end_headers()
+def etag_matches(header_value, etag):
+    """Evaluate an If-None-Match header against etag (weak comparison, RFC 9110)."""
+    if not header_value:
+        return False
+    if header_value.strip() == "*":
+        return True
+    for candidate in header_value.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
 
-    def do_OPTIONS(self):
-        """Handle preflight requests."""
-        self.send_response(200)
-        self.end_headers()
 
-    def guess_type(self, path):
-        """
-        Override guess_type to return explicit MIME types for Office/PDF files.
-        Prevent 'application/octet-stream' which confuses Chrome.
-        """
-        _, ext = os.path.splitext(path)
-        ext = ext.lower()
-        
-        mime_types = {
-            '.ppsx': 'application/vnd.openxmlformats-officedocument.presentationml.slideshow',
-            '.pptx': 'application/vnd.openxmlformats-officedocument.presentationml.presentation',
-            '.ppt': 'application/vnd.ms-powerpoint',
-            '.pps': 'application/vnd.ms-powerpoint',
-            '.pdf': 'application/pdf',
-            '.docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-            '.doc': 'application/msword',
-            '.xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            '.xls': 'application/vnd.ms-excel'
+def file_etag(stat_info):
+    """Strong ETag for a file, from its mtime and size."""
+    return f'"{stat_info.st_mtime_ns:x}-{stat_info.st_size:x}"'
+
+
+def parse_range_header(value, size):
+    """
+    Parse a Range header against a file of the given size.
+
+    Returns None when the header should be ignored (absent, malformed, not in
+    bytes, or too many ranges) and the whole file sent, an empty list when no
+    range is satisfiable (416), or a sorted list of merged (start, end)
+    inclusive byte ranges.
+    """
+    if not value or size == 0:
+        return None
+    unit, _, spec = value.partition("=")
+    if unit.strip().lower() != "bytes" or not spec.strip():
+        return None
+
+    ranges = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        first, sep, last = part.partition("-")
+        first, last = first.strip(), last.strip()
+        if not sep or not (first.isdigit() or first == "") or not (last.isdigit() or last == ""):
+            return None
+        if first == "":
+            # Suffix range: the last N bytes
+            if last == "":
+                return None
+            length = int(last)
+            if length == 0:
+                continue
+            ranges.append((max(size - length, 0), size - 1))
+        else:
+            start = int(first)
+            if last and int(last) < start:
+                return None
+            if start >= size:
+                continue
+            end = min(int(last), size - 1) if last else size - 1
+            ranges.append((start, end))
+
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+
+    if len(merged) > MAX_RANGES_PER_REQUEST:
+        return None
+    return merged
+
+
+def if_range_matches(value, etag, last_modified):
+    """True when a Range request may be honoured under its If-Range header."""
+    if not value:
+        return True
+    value = value.strip()
+    if value.startswith('"'):
+        return value == etag
+    if value.startswith("W/"):
+        # Weak validators never satisfy If-Range
+        return False
+    return value == last_modified
+
+
+def multipart_byteranges(ranges, content_type, size):
+    """
+    Lay out a multipart/byteranges body.
+
+    Returns (content_type, parts, trailer, content_length) where parts is a
+    list of (header_bytes, start, length) to be written in order, followed
+    by trailer.
+    """
+    boundary = secrets.token_hex(16)
+    parts = []
+    length = 0
+    for start, end in ranges:
+        header = (
+            f"\r\n--{boundary}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n"
+        ).encode("latin-1")
+        parts.append((header, start, end - start + 1))
+        length += len(header) + end - start + 1
+    trailer = f"\r\n--{boundary}--\r\n".encode("latin-1")
+    length += len(trailer)
+    return f"multipart/byteranges; boundary={boundary}", parts, trailer, length
+
+
+def ktls_send_active(sock):
+    """
+    True when the kernel encrypts writes on this TLS socket (kTLS), so file
+    data can be sent with os.sendfile without passing through Python.
+    """
+    if not sys.platform.startswith("linux"):
+        return False
+    try:
+        sock.getsockopt(SOL_TLS, TLS_TX, 64)
+        return True
+    except OSError:
+        return False
+
+
+def sendfile_all(sock, f, offset, count):
+    """os.sendfile count bytes of f to sock, for kTLS sockets (socket.sendfile refuses SSLSocket)."""
+    out_fd, in_fd = sock.fileno(), f.fileno()
+    while count > 0:
+        sent = os.sendfile(out_fd, in_fd, offset, count)
+        if sent == 0:
+            break
+        offset += sent
+        count -= sent
+
+
+def entry_extension(name):
+    """Lowercase extension without the dot, or None (as in listings)."""
+    _, extension = os.path.splitext(name)
+    return extension.lstrip('.').lower() if extension else None
+
+
+class EntryRecord:
+    """Compact metadata for one directory entry; mtime is None when it couldn't be stat'ed."""
+    __slots__ = ("name", "type", "size", "mtime", "parent")
+
+    def __init__(self, name, type, size, mtime, parent=None):
+        self.name = name
+        self.type = type
+        self.size = size
+        self.mtime = mtime
+        self.parent = parent
+
+    def as_dict(self):
+        """The entry as it appears in a JSON listing."""
+        return {
+            "name": self.name,
+            "extension": entry_extension(self.name),
+            "type": self.type,
+            "size_bytes": self.size,
+            "modified_timestamp": self.mtime if self.mtime is not None else 0,
+            "modified_iso": datetime.fromtimestamp(self.mtime).isoformat() if self.mtime is not None else None
         }
-        
-        if ext in mime_types:
-            logger.debug(f"Detected explicit MIME type for {ext}: {mime_types[ext]}")
-            return mime_types[ext]
-        
-        return super().guess_type(path)
 
-    def list_directory(self, path):
-        """JSON directory listing."""
+
+def scan_directory(path, parent=None):
+    """
+    Read a directory and return an EntryRecord per entry, sorted by
+    modification time (newest first). Raises OSError if the directory can't
+    be listed.
+
+    Uses a single os.scandir pass: the entry type comes from the directory
+    read itself and each entry is stat'ed at most once (on Windows the stat
+    result is already part of the directory read for regular files).
+    """
+    with os.scandir(path) as it:
+        records = list(scan_entries(it, parent))
+    records.sort(key=lambda r: r.mtime or 0, reverse=True)
+    return records
+
+
+def scan_entries(it, parent=None):
+    """EntryRecords for the entries of an os.scandir iterator, in directory order, as they are read."""
+    for entry in it:
         try:
-            file_list = os.listdir(path)
+            stat_info = entry.stat()
+            mtime = stat_info.st_mtime
+            size = stat_info.st_size
         except OSError:
-            self.send_error(404, "No permission to list directory")
+            mtime = None
+            size = 0
+
+        file_type = "file"
+        try:
+            if entry.is_dir():
+                file_type = "directory"
+            elif entry.is_symlink():
+                file_type = "symlink"
+        except OSError:
+            pass
+
+        yield EntryRecord(entry.name, file_type, size, mtime, parent)
+
+
+def read_directory(path):
+    """
+    Read a directory and return its entries as listing dicts sorted by
+    modification time (newest first). Raises OSError if the directory can't
+    be listed.
+    """
+    return [record.as_dict() for record in scan_directory(path)]
+
+
+def listing_etag(files):
+    """Strong ETag derived from the name, type, size and mtime of every entry."""
+    digest = hashlib.sha1()
+    for f in files:
+        digest.update(f"{f['name']}\0{f['type']}\0{f['size_bytes']}\0{f['modified_timestamp']!r}\n".encode('utf-8', 'surrogateescape'))
+    return f'"{digest.hexdigest()}"'
+
+
+class CachedListing:
+    """
+    One version of a directory: its entries, their content signature (ETag)
+    and the encoded JSON responses already produced for it, per display path.
+    Sort orders, filtered views and encoded entries of projected listings
+    are computed once per version too.
+    """
+    __slots__ = ("path", "mtime", "checked_at", "generated_at", "files", "etag", "bodies", "size",
+                 "orders", "views", "fragments", "compressed", "__weakref__")
+
+    def __init__(self, path, mtime, files):
+        self.path = path
+        self.mtime = mtime
+        self.checked_at = time.monotonic()
+        self.generated_at = datetime.now().isoformat()
+        self.files = files
+        self.etag = listing_etag(files)
+        self.bodies = {}
+        # (sort, descending) -> permutation of files; view key -> entries
+        self.orders = {}
+        self.views = {}
+        # (fields, compact, display path) -> {entry name: encoded entry}
+        self.fragments = {}
+        # (encoding, display path, ETag) -> compressed body
+        self.compressed = {}
+        # Rough in-memory footprint, used for the cache byte budget
+        self.size = 256 + sum(200 + 2 * len(f["name"]) for f in files)
+
+    def order(self, sort, descending):
+        """
+        Indexes of files in the given order ("name", "size" or "mtime"). Size
+        ties are broken by name; entries with the same mtime keep folder order.
+        """
+        key = (sort, descending)
+        order = self.orders.get(key)
+        if order is None:
+            files = self.files
+            if sort == "mtime":
+                # files is already newest first
+                order = range(len(files)) if descending else range(len(files) - 1, -1, -1)
+            elif sort == "size":
+                order = sorted(range(len(files)), key=lambda i: (files[i]["size_bytes"], files[i]["name"].casefold(),
+                                                                 files[i]["name"]),
+                               reverse=descending)
+            else:
+                order = sorted(range(len(files)), key=lambda i: (files[i]["name"].casefold(), files[i]["name"]),
+                               reverse=descending)
+            self.orders[key] = order
+        return order
+
+    def render(self, display_path):
+        """Return the encoded JSON listing as seen under display_path."""
+        body = self.bodies.get(display_path)
+        if body is None:
+            files = [
+                dict(f, path=os.path.join(display_path, f["name"]).replace("//", "/"))
+                for f in self.files
+            ]
+            response_data = {
+                "directory": display_path,
+                "total_items": len(files),
+                "generated_at": self.generated_at,
+                "files": files
+            }
+            body = json.dumps(response_data, indent=2).encode('utf-8')
+            self.bodies[display_path] = body
+        return body
+
+
+class ListingCache:
+    """
+    In-process cache of directory listings, keyed by the real directory path.
+
+    An entry is reused as long as the directory's own mtime is unchanged and
+    it was checked less than max_age seconds ago. The age limit matters because
+    a directory's mtime only changes when entries are added, removed or renamed,
+    not when a file inside it is rewritten in place. When a re-read finds the
+    same content signature the existing entry (and its encoded responses) is
+    kept. Entries are evicted in least-recently-used order once the total size
+    exceeds max_bytes.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_LISTING_CACHE_MB * 1024 * 1024,
+                 max_age=DEFAULT_LISTING_MAX_AGE_SECONDS):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path):
+        """Return the current CachedListing for path, reading the directory if needed."""
+        key = os.path.realpath(path)
+        mtime = os.stat(key).st_mtime
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.mtime == mtime:
+                if time.monotonic() - entry.checked_at < self.max_age:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry
+            self.misses += 1
+
+        # Read outside the lock so a slow folder doesn't block other listings
+        fresh = CachedListing(key, mtime, read_directory(key))
+        if entry is not None and entry.etag == fresh.etag:
+            with self._lock:
+                entry.mtime = mtime
+                entry.checked_at = fresh.checked_at
+            return entry
+        self._store(fresh)
+        return fresh
+
+    def hold(self, entry):
+        """Keep a listing built elsewhere (by the tree index) under the budget, as most recently used."""
+        with self._lock:
+            if self._entries.get(entry.path) is entry:
+                self._entries.move_to_end(entry.path)
+                self.hits += 1
+                return
+            self.misses += 1
+        self._store(entry)
+
+    def render(self, entry, display_path):
+        """Encoded JSON body for entry, charging newly encoded bytes to the budget."""
+        if display_path in entry.bodies:
+            return entry.bodies[display_path]
+        body = entry.render(display_path)
+        self.charge(entry, len(body))
+        return body
+
+    def charge(self, entry, size):
+        """Count size more (or, if negative, fewer) bytes against the budget for a cached entry."""
+        with self._lock:
+            if self._entries.get(entry.path) is entry:
+                entry.size += size
+                self._size += size
+                self._evict()
+
+    def _store(self, entry):
+        with self._lock:
+            old = self._entries.pop(entry.path, None)
+            if old is not None:
+                self._size -= old.size
+            if entry.size > self.max_bytes:
+                return
+            self._entries[entry.path] = entry
+            self._size += entry.size
+            self._evict()
+
+    def _evict(self):
+        while self._size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= evicted.size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+
+class ListingHistory:
+    """
+    Recent versions of each folder's listing, keyed by the real directory
+    path, so clients can ask what changed since a version (or a time) they
+    already know. A version is recorded when a listing of it is first
+    served, with the time it was first seen; its entries are shared with the
+    cached listing, so only superseded versions cost memory. Least recently
+    used folders are dropped once more than max_entries entries are kept.
+    """
+
+    def __init__(self, max_versions=DELTA_HISTORY_VERSIONS, max_entries=DELTA_HISTORY_ENTRIES):
+        self.max_versions = max_versions
+        self.max_entries = max_entries
+        self._dirs = OrderedDict()  # path -> [(version, seen_at, files)], oldest first
+        self._entries = 0
+        self._lock = threading.Lock()
+        self.deltas = 0
+        self.resets = 0
+
+    def observe(self, path, listing):
+        """Record the listing's version for path if it's new."""
+        path = os.path.realpath(path)
+        version = listing_version(listing)
+        with self._lock:
+            versions = self._dirs.get(path)
+            if versions is None:
+                versions = self._dirs[path] = []
+            else:
+                self._dirs.move_to_end(path)
+                if versions[-1][0] == version:
+                    return
+            versions.append((version, time.time(), listing.files))
+            self._entries += len(listing.files)
+            while len(versions) > self.max_versions:
+                self._entries -= len(versions.pop(0)[2])
+            while self._entries > self.max_entries and len(self._dirs) > 1:
+                _, dropped = self._dirs.popitem(last=False)
+                self._entries -= sum(len(files) for _, _, files in dropped)
+            while self._entries > self.max_entries and len(versions) > 1:
+                self._entries -= len(versions.pop(0)[2])
+
+    def find(self, path, version=None, at=None):
+        """
+        (version, entries) of the recorded version of path with the given
+        token, or the one that was current at time at; None if it isn't known.
+        """
+        path = os.path.realpath(path)
+        with self._lock:
+            versions = list(self._dirs.get(path, ()))
+        if version is not None:
+            for recorded in versions:
+                if recorded[0] == version:
+                    return recorded[0], recorded[2]
             return None
+        found = None
+        for recorded, seen_at, files in versions:
+            if seen_at > at:
+                break
+            found = (recorded, files)
+        return found
 
-        display_path = urllib.parse.unquote(self.path)
-        files = []
+    def count(self, reset):
+        with self._lock:
+            if reset:
+                self.resets += 1
+            else:
+                self.deltas += 1
 
-        for name in file_list:
-            fullname = os.path.join(path, name)
-            
+    def stats(self):
+        with self._lock:
+            return {
+                "directories": len(self._dirs),
+                "versions": sum(len(versions) for versions in self._dirs.values()),
+                "entries": self._entries,
+                "deltas": self.deltas,
+                "resets": self.resets
+            }
+
+
+class IndexedDirectory:
+    """A directory in the TreeIndex: its mtime when scanned and its entries."""
+    __slots__ = ("path", "parent", "mtime", "scanned_at", "entries", "listing", "summary")
+
+    def __init__(self, path, parent, mtime, entries):
+        self.path = path
+        self.parent = parent
+        self.mtime = mtime
+        self.scanned_at = time.monotonic()
+        self.entries = entries
+        # Weak reference to the CachedListing, built the first time the
+        # directory is requested; the listing cache holds the listing itself
+        self.listing = None
+        # SearchSummary, built when the index scans the directory
+        self.summary = None
+
+    def cached_listing(self, listing_cache=None):
+        """
+        CachedListing for this version of the directory. It's kept in
+        listing_cache, under its byte budget, and rebuilt once evicted.
+        """
+        listing = self.listing() if self.listing is not None else None
+        if listing is None:
+            listing = CachedListing(self.path, self.mtime, [r.as_dict() for r in self.entries])
+            self.listing = weakref.ref(listing)
+        if listing_cache is not None:
+            listing_cache.hold(listing)
+        return listing
+
+    def search_summary(self):
+        summary = self.summary
+        if summary is None:
+            summary = self.summary = SearchSummary(self.entries)
+        return summary
+
+
+def trigram_signature(text):
+    """Bitmask with one bit set per trigram of text (hashed into SEARCH_SIGNATURE_BITS)."""
+    signature = 0
+    for i in range(len(text) - 2):
+        signature |= 1 << (hash(text[i:i + 3]) % SEARCH_SIGNATURE_BITS)
+    return signature
+
+
+class SearchSummary:
+    """
+    What a search needs to know about one directory without looking at its
+    entries one by one:
+
+    - names: every lowercase name, each followed by "/" (which can't appear
+      in a name), so one substring test covers the whole directory and a hit
+      never spans two names; offsets maps a hit back to its entry
+    - signature: trigram bitmask of all names; a query whose trigram bits
+      aren't all set can't match anything here
+    - extensions and the oldest/newest mtime, for the other filters
+    """
+    __slots__ = ("names", "offsets", "signature", "extensions", "oldest", "newest")
+
+    def __init__(self, entries):
+        lowered = [r.name.lower() for r in entries]
+        offsets = []
+        position = 0
+        for name in lowered:
+            offsets.append(position)
+            position += len(name) + 1
+        self.names = "".join(name + "/" for name in lowered)
+        self.offsets = offsets
+        signature = 0
+        for name in lowered:
+            signature |= trigram_signature(name)
+        self.signature = signature
+        self.extensions = frozenset(entry_extension(r.name) for r in entries)
+        mtimes = [r.mtime for r in entries if r.mtime is not None] or [0]
+        self.oldest = min(mtimes)
+        self.newest = max(mtimes)
+
+    def matching(self, query):
+        """Indexes of the entries whose lowercase name contains query."""
+        names = self.names
+        offsets = self.offsets
+        position = names.find(query)
+        while position != -1:
+            index = bisect.bisect_right(offsets, position) - 1
+            yield index
+            if index + 1 >= len(offsets):
+                break
+            position = names.find(query, offsets[index + 1])
+
+
+class TreeIndex:
+    """
+    In-memory metadata for every file and folder under root, keyed by real
+    directory path. A background thread walks the whole tree once, then every
+    interval seconds stats each directory and re-reads only those whose mtime
+    changed (or that were last read more than INDEX_RESCAN_AGE_SECONDS ago).
+
+    Directory listings are answered from the index after a single stat of the
+    requested directory; a changed mtime, or a scan older than max_age
+    seconds, re-reads just that directory.
+    Directories outside root (reached through symlinks) are not indexed and
+    fall back to a live read.
+
+    With a snapshot path, the index is saved there after it changes (at most
+    every INDEX_SNAPSHOT_INTERVAL_SECONDS) and loaded at startup instead of
+    walking the tree; the first refresh pass then re-reads every directory in
+    the background, so files edited while the server was down show up.
+    """
+
+    def __init__(self, root, interval=DEFAULT_INDEX_INTERVAL_SECONDS, snapshot=None,
+                 max_age=DEFAULT_LISTING_MAX_AGE_SECONDS):
+        self.root = os.path.realpath(root)
+        self.interval = interval
+        self.max_age = max_age
+        self.snapshot = snapshot
+        self.loaded_from_snapshot = False
+        self.saved_at = None
+        self._saved_rescans = 0
+        self._prefix = self.root.rstrip(os.sep) + os.sep
+        self._dirs = {}
+        self._lock = threading.Lock()
+        self.ready = False
+        self.build_seconds = None
+        self.passes = 0
+        self.rescans = 0
+        self.hits = 0
+        self.misses = 0
+        self._thread = None
+        # Called as on_change(path, node, old) when a folder's entries change
+        # once the index is built, with node None when the folder is gone and
+        # old None when it's new
+        self.on_change = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="tree-index", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        if self.snapshot is not None:
+            try:
+                self._load_snapshot()
+            except Exception:
+                logger.exception(f"Could not use tree index snapshot {self.snapshot}; walking the tree instead")
+                self._reset()
+        while not self.ready:
+            try:
+                self._build()
+            except Exception:
+                logger.exception("Building the tree index failed; retrying")
+                self._reset()
+                time.sleep(self.interval)
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.refresh()
+                self._save_if_changed()
+            except Exception:
+                logger.exception("Tree index refresh failed")
+
+    def _load_snapshot(self):
+        started = time.monotonic()
+        if not self.load(self.snapshot):
+            return
+        self.loaded_from_snapshot = True
+        self.build_seconds = round(time.monotonic() - started, 3)
+        self.ready = True
+        stats = self.stats()
+        logger.info(f"Tree index loaded from {self.snapshot}: {stats['directories']} folders, "
+                    f"{stats['entries']} entries in {self.build_seconds}s; reconciling in the background")
+        self.refresh()
+        self._save_if_changed()
+
+    def _build(self):
+        started = time.monotonic()
+        self._walk(self.root, None)
+        self.build_seconds = round(time.monotonic() - started, 2)
+        self.ready = True
+        stats = self.stats()
+        logger.info(f"Tree index built: {stats['directories']} folders, "
+                    f"{stats['entries']} entries in {self.build_seconds}s")
+        self._save_if_changed(force=True)
+
+    def _reset(self):
+        """Forget everything indexed so far; listings are read live until the next build."""
+        self.ready = False
+        self.loaded_from_snapshot = False
+        with self._lock:
+            self._dirs = {}
+
+    def _contains(self, path):
+        return path == self.root or path.startswith(self._prefix)
+
+    def _scan(self, path, parent):
+        """Read one directory into the index; returns the real paths of its sub-folders."""
+        try:
+            mtime = os.stat(path).st_mtime
+            node = IndexedDirectory(path, parent, mtime, [])
+            node.entries = scan_directory(path, node)
+            node.search_summary()
+        except OSError:
+            self._remove(path)
+            return []
+        with self._lock:
+            old = self._dirs.get(path)
+            listing = old.listing() if old is not None and old.listing is not None else None
+            if listing is not None:
+                # Keep the encoded listing when nothing visible changed
+                fresh = node.cached_listing()
+                if fresh.etag == listing.etag:
+                    listing.mtime = mtime
+                    node.listing = old.listing
+            self._dirs[path] = node
+            self.rescans += 1
+        if self.on_change is not None and self.ready and (
+                old is None or [(r.name, r.type, r.size, r.mtime) for r in old.entries]
+                != [(r.name, r.type, r.size, r.mtime) for r in node.entries]):
+            self.on_change(path, node, old)
+        children = []
+        for record in node.entries:
+            if record.type == "directory":
+                child = os.path.realpath(os.path.join(path, record.name))
+                if child != path and self._contains(child):
+                    children.append(child)
+        return children
+
+    def _walk(self, path, parent):
+        """Index path and every folder below it not already indexed."""
+        pending = [(path, parent)]
+        while pending:
+            path, parent = pending.pop()
+            for child in self._scan(path, parent):
+                if child not in self._dirs:
+                    pending.append((child, path))
+
+    def _remove(self, path):
+        """Drop a directory and everything indexed below it."""
+        prefix = path.rstrip(os.sep) + os.sep
+        with self._lock:
+            removed = [(k, node) for k, node in self._dirs.items() if k == path or k.startswith(prefix)]
+            for key, _ in removed:
+                del self._dirs[key]
+        if self.on_change is not None and self.ready:
+            for key, old in removed:
+                self.on_change(key, None, old)
+
+    def _rescan(self, node):
+        before = {r.name for r in node.entries if r.type == "directory"}
+        children = self._scan(node.path, node.parent)
+        after = {r.name for r in self._dirs[node.path].entries if r.type == "directory"} \
+            if node.path in self._dirs else set()
+        for name in before - after:
+            self._remove(os.path.join(node.path, name))
+        for child in children:
+            if child not in self._dirs:
+                self._walk(child, node.path)
+
+    def refresh(self):
+        """One incremental pass: re-read directories whose mtime changed or whose scan is old."""
+        with self._lock:
+            nodes = list(self._dirs.values())
+        now = time.monotonic()
+        for node in nodes:
+            if self._dirs.get(node.path) is not node:
+                continue
             try:
-                stat_info = os.stat(fullname)
-                modified_timestamp = stat_info.st_mtime
-                modified_iso = datetime.fromtimestamp(modified_timestamp).isoformat()
-                size_bytes = stat_info.st_size
+                mtime = os.stat(node.path).st_mtime
             except OSError:
-                modified_timestamp = 0
-                modified_iso = None
-                size_bytes = 0
+                self._remove(node.path)
+                continue
+            if mtime != node.mtime or now - node.scanned_at >= INDEX_RESCAN_AGE_SECONDS:
+                self._rescan(node)
+        self.passes += 1
 
-            file_type = "file"
-            if os.path.isdir(fullname):
-                file_type = "directory"
-            elif os.path.islink(fullname):
-                file_type = "symlink"
+    def _save_if_changed(self, force=False):
+        if self.snapshot is None:
+            return
+        if not force:
+            if self.rescans == self._saved_rescans:
+                return
+            if self.saved_at is not None and time.time() - self.saved_at < INDEX_SNAPSHOT_INTERVAL_SECONDS:
+                return
+        self.save(self.snapshot)
 
-            _, extension = os.path.splitext(name)
-            extension = extension.lstrip('.').lower() if extension else None
-
-            files.append({
-                "name": name,
-                "extension": extension,
-                "type": file_type,
-                "size_bytes": size_bytes,
-                "modified_timestamp": modified_timestamp,
-                "modified_iso": modified_iso,
-                "path": os.path.join(display_path, name).replace("//", "/")
-            })
+    def save(self, path):
+        """Write the index to path (atomically, via a temporary file)."""
+        with self._lock:
+            nodes = list(self._dirs.values())
+            rescans = self.rescans
+        directories = [
+            [os.path.relpath(node.path, self.root), node.mtime,
+             [[r.name, r.type, r.size, r.mtime] for r in node.entries]]
+            for node in nodes
+        ]
+        data = {
+            "version": INDEX_SNAPSHOT_VERSION,
+            "root": self.root,
+            "saved_at": time.time(),
+            "directories": directories
+        }
+        tmp = f"{path}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(data, f, separators=(",", ":"))
+            os.replace(tmp, path)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not save tree index snapshot to {path}: {e}")
+            return
+        self.saved_at = data["saved_at"]
+        self._saved_rescans = rescans
+        logger.debug(f"Saved tree index snapshot: {len(directories)} folders")
+
+    def load(self, path):
+        """Replace the index with the snapshot at path; False if it's missing, stale or for another root."""
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") != INDEX_SNAPSHOT_VERSION or data.get("root") != self.root:
+                logger.info(f"Ignoring tree index snapshot {path}: different format or content folder")
+                return False
+            dirs = {}
+            for rel, mtime, entries in data["directories"]:
+                node_path = self.root if rel == "." else os.path.join(self.root, rel)
+                parent = os.path.dirname(node_path) if node_path != self.root else None
+                node = IndexedDirectory(node_path, parent, mtime, [])
+                # Never read by this process: due on the first pass or request
+                node.scanned_at = float("-inf")
+                node.entries = [EntryRecord(name, type, size, entry_mtime, node)
+                                for name, type, size, entry_mtime in entries]
+                dirs[node_path] = node
+            for node in dirs.values():
+                node.search_summary()
+            saved_at = data.get("saved_at")
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            logger.warning(f"Could not load tree index snapshot {path}: {e}")
+            return False
+        with self._lock:
+            self._dirs = dirs
+        self.saved_at = saved_at
+        return True
 
-        files.sort(key=lambda x: x["modified_timestamp"], reverse=True)
+    def listing(self, path, listing_cache=None):
+        """
+        CachedListing for path from the index, kept in listing_cache if given,
+        or None if the folder isn't indexed.
+        """
+        node = self.directory(path)
+        return node.cached_listing(listing_cache) if node is not None else None
 
-        response_data = {
-            "directory": display_path,
-            "total_items": len(files),
-            "generated_at": datetime.now().isoformat(),
-            "files": files
+    def directory(self, path):
+        """
+        Current IndexedDirectory for path, re-read first if it changed or its
+        scan is too old; None if the folder isn't indexed.
+        """
+        key = os.path.realpath(path)
+        node = self._dirs.get(key)
+        if node is None:
+            self.misses += 1
+            return None
+        if os.stat(key).st_mtime != node.mtime or time.monotonic() - node.scanned_at >= self.max_age:
+            self._rescan(node)
+            node = self._dirs.get(key)
+            if node is None:
+                raise FileNotFoundError(key)
+        self.hits += 1
+        return node
+
+    def search(self, query="", extensions=None, types=None, modified_after=None, modified_before=None,
+               under=None, limit=DEFAULT_SEARCH_LIMIT):
+        """
+        Entries whose name contains query (case-insensitive) and that match
+        the other filters, newest first. Returns (total matches, up to limit
+        (directory path, EntryRecord) pairs).
+        """
+        query = query.lower()
+        if "/" in query:
+            return 0, []
+        signature = trigram_signature(query)
+        under_prefix = under.rstrip(os.sep) + os.sep if under is not None else None
+        with self._lock:
+            nodes = list(self._dirs.values())
+        matches = []
+        for node in nodes:
+            if under is not None and node.path != under and not node.path.startswith(under_prefix):
+                continue
+            summary = node.search_summary()
+            if summary.signature & signature != signature:
+                continue
+            if extensions and summary.extensions.isdisjoint(extensions):
+                continue
+            if modified_after is not None and summary.newest < modified_after:
+                continue
+            if modified_before is not None and summary.oldest > modified_before:
+                continue
+            if query:
+                entries = node.entries
+                records = [entries[i] for i in summary.matching(query)]
+            else:
+                records = node.entries
+            for record in records:
+                if extensions and entry_extension(record.name) not in extensions:
+                    continue
+                if types and record.type not in types:
+                    continue
+                mtime = record.mtime or 0
+                if modified_after is not None and mtime < modified_after:
+                    continue
+                if modified_before is not None and mtime > modified_before:
+                    continue
+                matches.append((node.path, record))
+        top = heapq.nlargest(limit, matches, key=lambda match: match[1].mtime or 0)
+        return len(matches), top
+
+    def url_path(self, path):
+        """URL path of an indexed directory, relative to the served root."""
+        rel = os.path.relpath(path, self.root)
+        return "/" if rel == "." else "/" + rel.replace(os.sep, "/") + "/"
+
+    def stats(self):
+        with self._lock:
+            nodes = list(self._dirs.values())
+        return {
+            "ready": self.ready,
+            "directories": len(nodes),
+            "entries": sum(len(node.entries) for node in nodes),
+            "build_seconds": self.build_seconds,
+            "loaded_from_snapshot": self.loaded_from_snapshot,
+            "snapshot_saved_at": datetime.fromtimestamp(self.saved_at).isoformat(timespec="seconds") if self.saved_at else None,
+            "refresh_passes": self.passes,
+            "directory_scans": self.rescans,
+            "hits": self.hits,
+            "misses": self.misses
         }
 
-        content = json.dumps(response_data, indent=2)
-        encoded = content.encode('utf-8')
-        
-        f = BytesIO()
-        f.write(encoded)
-        length = f.tell()
-        f.seek(0)
-        
-        self.send_response(200)
-        self.send_header("Content-Type", "application/json; charset=utf-8")
-        self.send_header("Content-Length", str(length))
-        self.end_headers()
-        return f
 
+class ChangeFeed:
+    """
+    Fans out folder changes seen by the tree index to /_events subscribers:
+    each change is encoded once as a Server-Sent Event and queued for every
+    client watching that folder or one above it. The last EVENTS_BACKLOG
+    events are kept so clients reconnecting with Last-Event-ID miss nothing.
+    Event ids are "<epoch>-<n>" with an epoch chosen per process, so an id
+    from before a restart is recognised as such and answered with a reset.
+    """
 
-class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
-    """Handle requests in separate threads for concurrent processing."""
-    daemon_threads = True  # Don't wait for threads to finish on shutdown
+    def __init__(self, tree_index, backlog=EVENTS_BACKLOG, max_subscribers=MAX_EVENT_SUBSCRIBERS):
+        self.tree_index = tree_index
+        self.max_subscribers = max_subscribers
+        self._subscribers = set()
+        self._recent = deque(maxlen=backlog)  # (id, path, encoded event)
+        self.epoch = secrets.token_hex(4)
+        self._next_id = 1
+        self._lock = threading.Lock()
+        self.published = 0
+        self.delivered = 0
+        tree_index.on_change = self.publish
 
+    def publish(self, path, node, old=None):
+        """
+        Queue an event for a changed (or, with node None, removed) folder;
+        old is the folder as indexed before the change, None if it's new.
+        """
+        data = {
+            "directory": self.tree_index.url_path(path),
+            "version": listing_version(node.cached_listing()) if node is not None else None,
+            "since_version": listing_version(old.cached_listing()) if old is not None else None,
+            "removed": node is None,
+            "changed_at": datetime.now().isoformat()
+        }
+        with self._lock:
+            event_id = self._next_id
+            self._next_id += 1
+            event = f"id: {self.epoch}-{event_id}\nevent: change\ndata: {json.dumps(data)}\n\n".encode('utf-8')
+            self._recent.append((event_id, path, event))
+            self.published += 1
+            subscribers = [s for s in self._subscribers if s.covers(path)]
+            self.delivered += len(subscribers)
+        for subscriber in subscribers:
+            subscriber.push(event)
 
-def run_server(port=DEFAULT_PORT, directory=None, skip_drive_check=False, certfile=None, keyfile=None):
-    if not skip_drive_check:
-        if not wait_for_google_drive():
-            sys.exit(1)
+    def subscribe(self, path, last_event_id=None):
+        """
+        New ChangeSubscription for path and below, or None if there are too
+        many. With the Last-Event-ID a client reconnects with, it first gets
+        the events it missed, or a reset if they can't all be replayed.
+        """
+        subscriber = ChangeSubscription(self, path)
+        with self._lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                return None
+            self._subscribers.add(subscriber)
+            if last_event_id is not None:
+                epoch, _, seen = last_event_id.partition("-")
+                seen = int(seen) if epoch == self.epoch and seen.isdigit() else None
+                if seen is None or seen >= self._next_id or (
+                        seen + 1 < self._next_id and (not self._recent or self._recent[0][0] > seen + 1)):
+                    # From another process, or events were missed and are no
+                    # longer kept; the id lets the client resume from here
+                    subscriber.push(f"id: {self.epoch}-{self._next_id - 1}\nevent: reset\ndata: {{}}\n\n".encode('utf-8'))
+                else:
+                    for event_id, changed, event in self._recent:
+                        if event_id > seen and subscriber.covers(changed):
+                            subscriber.push(event)
+        return subscriber
 
-    if directory:
-        os.chdir(directory)
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
 
-    server_address = ('', port)
-    httpd = ThreadedHTTPServer(server_address, DirectoryHandler)
-    
-    # Enable HTTPS if certfile is provided
-    protocol = "http"
-    if certfile:
-        # Clean up paths (remove quotes if passed by shell/batch erroneously)
-        certfile = certfile.strip('"').strip("'")
-        if keyfile:
-            keyfile = keyfile.strip('"').strip("'")
-            
-        import ssl
-        if not keyfile:
-            # Assume combined cert/key or key is in certfile
-            keyfile = certfile
-            
-        logger.info(f"Enabling HTTPS using cert: {certfile}")
-        
-        # Create SSL context
-        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    def stats(self):
+        with self._lock:
+            return {
+                "subscribers": len(self._subscribers),
+                "max_subscribers": self.max_subscribers,
+                "published": self.published,
+                "delivered": self.delivered,
+                "last_event_id": f"{self.epoch}-{self._next_id - 1}"
+            }
+
+
+class ChangeSubscription:
+    """
+    One /_events stream: the events for a folder and everything below it.
+    Used as the chunks of a Response, so it can be iterated from a handler
+    thread or, without tying up an executor thread, from the asyncio loop.
+    Yields a comment line when nothing happened for EVENTS_HEARTBEAT_SECONDS.
+    """
+
+    def __init__(self, feed, path):
+        self.feed = feed
+        self.path = path
+        self._prefix = path.rstrip(os.sep) + os.sep
+        self._pending = [f"retry: {EVENTS_RETRY_MS}\n: watching {feed.tree_index.url_path(path)}\n\n".encode('utf-8')]
+        self._cond = threading.Condition()
+        self._loop = None
+        self._waker = None
+        self.closed = False
+
+    def covers(self, path):
+        return path == self.path or path.startswith(self._prefix)
+
+    def push(self, event):
+        with self._cond:
+            if len(self._pending) >= MAX_EVENTS_QUEUED:
+                # Too far behind: drop the queue and have the client re-sync
+                self._pending = [b"event: reset\ndata: {}\n\n"]
+            self._pending.append(event)
+            self._cond.notify()
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(self._waker.set)
+
+    def _take(self):
+        pending = self._pending
+        self._pending = []
+        return b"".join(pending) or b": keep-alive\n\n"
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self._cond:
+            if self.closed:
+                raise StopIteration
+            if not self._pending:
+                self._cond.wait(EVENTS_HEARTBEAT_SECONDS)
+            return self._take()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+            self._waker = asyncio.Event()
+        with self._cond:
+            if self.closed:
+                raise StopAsyncIteration
+            self._waker.clear()
+            waiting = not self._pending
+        if waiting:
+            try:
+                await asyncio.wait_for(self._waker.wait(), EVENTS_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+        with self._cond:
+            return self._take()
+
+    def close(self):
+        self.feed.unsubscribe(self)
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+class HotFileCache:
+    """
+    Shared in-memory cache of whole file contents for files downloaded by many
+    devices within minutes (the same PPSX for a whole class).
+
+    Entries are keyed by path and only valid for the size and mtime they were
+    read at, so a replaced file is re-read. Files are admitted on their
+    HOT_CACHE_ADMIT_AFTER-th request and evicted least-recently-used once the
+    total exceeds max_bytes. Concurrent requests for a file being loaded wait
+    for that single read instead of reading it again. Callers get read-only
+    memoryviews, so ranges are served as zero-copy slices.
+    """
+
+    def __init__(self, max_bytes, max_file_bytes=DEFAULT_HOT_CACHE_MAX_FILE_MB * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_file_bytes = min(max_file_bytes, max_bytes)
+        self._entries = OrderedDict()   # path -> (size, mtime_ns, data)
+        self._seen = OrderedDict()      # (path, size, mtime_ns) -> request count
+        self._loading = {}              # (path, size, mtime_ns) -> threading.Event
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.evictions = 0
+
+    def get(self, path, stat_info):
+        """Return a memoryview of the file's contents, or None to read it from disk."""
+        size, mtime_ns = stat_info.st_size, stat_info.st_mtime_ns
+        key = (path, size, mtime_ns)
+
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None:
+                if entry[0] == size and entry[1] == mtime_ns:
+                    self._entries.move_to_end(path)
+                    self.hits += 1
+                    return memoryview(entry[2])
+                self._discard(path)
+            self.misses += 1
+
+            if size == 0 or size > self.max_file_bytes:
+                return None
+            count = self._seen.pop(key, 0) + 1
+            self._seen[key] = count
+            if len(self._seen) > HOT_CACHE_SEEN_WINDOW:
+                self._seen.popitem(last=False)
+            if count < HOT_CACHE_ADMIT_AFTER:
+                return None
+
+            loading = self._loading.get(key)
+            if loading is None:
+                self._loading[key] = threading.Event()
+
+        if loading is not None:
+            loading.wait(60)
+            with self._lock:
+                entry = self._entries.get(path)
+                if entry is not None and entry[0] == size and entry[1] == mtime_ns:
+                    return memoryview(entry[2])
+            return None
+
+        data = None
         try:
-            context.load_cert_chain(certfile=certfile, keyfile=keyfile)
-            httpd.socket = context.wrap_socket(httpd.socket, server_side=True)
-            protocol = "https"
-        except Exception as e:
-            logger.error(f"Failed to load SSL certificate: {e}")
-            sys.exit(1)
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError as e:
+            logger.debug(f"Hot cache could not read {path}: {e}")
+        finally:
+            with self._lock:
+                if data is not None and len(data) == size:
+                    self._entries[path] = (size, mtime_ns, data)
+                    self._size += size
+                    self._seen.pop(key, None)
+                    self.loads += 1
+                    while self._size > self.max_bytes:
+                        self._discard(next(iter(self._entries)))
+                        self.evictions += 1
+                else:
+                    data = None
+                self._loading.pop(key).set()
+        return memoryview(data) if data is not None else None
+
+    def _discard(self, path):
+        size, _, _ = self._entries.pop(path)
+        self._size -= size
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "loads": self.loads,
+                "evictions": self.evictions
+            }
+
+
+class GzipFileCache:
+    """
+    Gzip-compressed copies of compressible files (PDF, SVG, HTML, subtitles,
+    ...), kept in a local cache folder rather than next to the files in
+    Google Drive.
+
+    A copy is named after the file's path, size and mtime, so a changed file
+    has no copy until it is rebuilt. Copies are built by a background thread
+    for files that have been requested; until then, and for files that don't
+    compress well, the file is sent as it is. The oldest copies are deleted
+    once the folder exceeds max_bytes.
+    """
+
+    def __init__(self, cache_dir, max_bytes, max_file_bytes=GZIP_CACHE_MAX_FILE_MB * 1024 * 1024):
+        self.cache_dir = str(cache_dir)
+        self.max_bytes = max_bytes
+        self.max_file_bytes = min(max_file_bytes, max_bytes)
+        self._files = OrderedDict()     # copy name -> size, oldest first
+        self._by_source = {}            # path key -> copy name
+        self._skip = OrderedDict()      # (path, size, mtime_ns) that didn't compress well
+        self._pending = set()
+        self._queue = queue.Queue(GZIP_CACHE_QUEUE_SIZE)
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.builds = 0
+        self.skipped = 0
+        self.evictions = 0
+        self.bytes_saved = 0
+
+    def start(self):
+        """Pick up copies left by a previous run and start the builder thread."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        existing = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                try:
+                    if entry.name.endswith(".tmp"):
+                        os.remove(entry.path)
+                    elif entry.name.endswith(".gz"):
+                        st = entry.stat()
+                        existing.append((st.st_mtime, entry.name, st.st_size))
+                except OSError:
+                    pass
+        with self._lock:
+            for _, name, size in sorted(existing):
+                self._add(name, size)
+            self._evict()
+        threading.Thread(target=self._run, name="gzip-cache", daemon=True).start()
+
+    @staticmethod
+    def _source_key(path):
+        return hashlib.sha1(path.encode('utf-8', 'surrogateescape')).hexdigest()
+
+    def _copy_name(self, path, size, mtime_ns):
+        return f"{self._source_key(path)}-{size:x}-{mtime_ns:x}.gz"
+
+    def eligible(self, path, stat_info):
+        """Whether a compressed copy is kept for this file."""
+        return (GZIP_CACHE_MIN_BYTES <= stat_info.st_size <= self.max_file_bytes
+                and os.path.splitext(path)[1].lower() in GZIP_COMPRESSIBLE_EXTENSIONS)
+
+    def open(self, path, stat_info):
+        """
+        Open the compressed copy of the file's current version, or return None
+        (and queue it to be built) if there isn't one yet.
+        """
+        key = (path, stat_info.st_size, stat_info.st_mtime_ns)
+        name = self._copy_name(*key)
+        with self._lock:
+            known = name in self._files
+        if known:
+            try:
+                f = open(os.path.join(self.cache_dir, name), 'rb')
+                with self._lock:
+                    self.hits += 1
+                return f
+            except OSError:
+                pass
+        with self._lock:
+            self.misses += 1
+            if key in self._pending or key in self._skip:
+                return None
+            try:
+                self._queue.put_nowait(key)
+                self._pending.add(key)
+            except queue.Full:
+                pass
+        return None
+
+    def _run(self):
+        while True:
+            key = self._queue.get()
+            try:
+                self._build(*key)
+            except Exception as e:
+                logger.warning(f"Could not compress {key[0]}: {e}")
+            finally:
+                with self._lock:
+                    self._pending.discard(key)
+
+    def _build(self, path, size, mtime_ns):
+        name = self._copy_name(path, size, mtime_ns)
+        target = os.path.join(self.cache_dir, name)
+        tmp = target + ".tmp"
+        try:
+            with open(path, 'rb') as src:
+                with open(tmp, 'wb') as raw, \
+                        gzip.GzipFile(filename="", mode="wb", fileobj=raw, compresslevel=9, mtime=0) as gz:
+                    shutil.copyfileobj(src, gz, COPY_BUFFER_SIZE)
+                st = os.fstat(src.fileno())
+            compressed = os.path.getsize(tmp)
+            if st.st_size != size or st.st_mtime_ns != mtime_ns:
+                # Changed while being compressed; the next request queues the new version
+                os.remove(tmp)
+                return
+            if compressed > size * (1 - GZIP_CACHE_MIN_SAVING):
+                os.remove(tmp)
+                with self._lock:
+                    self._skip[(path, size, mtime_ns)] = True
+                    if len(self._skip) > HOT_CACHE_SEEN_WINDOW:
+                        self._skip.popitem(last=False)
+                    self.skipped += 1
+                return
+            os.replace(tmp, target)
+        except OSError:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+        with self._lock:
+            self._add(name, compressed)
+            self.builds += 1
+            self.bytes_saved += size - compressed
+            self._evict()
+        logger.debug(f"Compressed {path}: {size} -> {compressed} bytes")
+
+    def _add(self, name, size):
+        """Record a copy; an older copy of the same file is deleted. Called with the lock held."""
+        source_key = name.split("-", 1)[0]
+        previous = self._by_source.get(source_key)
+        if previous is not None and previous != name:
+            self._delete(previous)
+        self._by_source[source_key] = name
+        self._size += size - self._files.pop(name, 0)
+        self._files[name] = size
+
+    def _delete(self, name):
+        try:
+            os.remove(os.path.join(self.cache_dir, name))
+        except FileNotFoundError:
+            pass
+        except OSError:
+            # Still being sent (Windows can't delete open files); keep it for now
+            return False
+        self._size -= self._files.pop(name)
+        source_key = name.split("-", 1)[0]
+        if self._by_source.get(source_key) == name:
+            del self._by_source[source_key]
+        return True
+
+    def _evict(self):
+        for name in list(self._files):
+            if self._size <= self.max_bytes:
+                break
+            if self._delete(name):
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "files": len(self._files),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "builds": self.builds,
+                "skipped": self.skipped,
+                "evictions": self.evictions,
+                "pending": len(self._pending),
+                "bytes_saved": self.bytes_saved
+            }
+
+
+MIME_TYPES = {
+    '.ppsx': 'application/vnd.openxmlformats-officedocument.presentationml.slideshow',
+    '.pptx': 'application/vnd.openxmlformats-officedocument.presentationml.presentation',
+    '.ppt': 'application/vnd.ms-powerpoint',
+    '.pps': 'application/vnd.ms-powerpoint',
+    '.pdf': 'application/pdf',
+    '.docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    '.doc': 'application/msword',
+    '.xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    '.xls': 'application/vnd.ms-excel'
+}
+
+# Force download for PowerPoint files (Chrome doesn't handle them well natively)
+FORCE_DOWNLOAD_EXTENSIONS = {'.ppsx', '.pptx', '.ppt', '.pps'}
+
+
+def guess_mime_type(path):
+    """
+    Return explicit MIME types for Office/PDF files, otherwise guess like
+    SimpleHTTPRequestHandler. Prevents 'application/octet-stream' which
+    confuses Chrome.
+    """
+    _, ext = os.path.splitext(path)
+    if ext.lower() in MIME_TYPES:
+        return MIME_TYPES[ext.lower()]
+    extensions_map = SimpleHTTPRequestHandler.extensions_map
+    if ext in extensions_map:
+        return extensions_map[ext]
+    if ext.lower() in extensions_map:
+        return extensions_map[ext.lower()]
+    guess, _ = mimetypes.guess_type(path)
+    return guess or 'application/octet-stream'
+
+
+def common_headers(url):
+    """CORS headers, plus Content-Disposition for files that must be downloaded."""
+    headers = [
+        ("Access-Control-Allow-Origin", "*"),
+        ("Access-Control-Allow-Methods", "GET, OPTIONS"),
+        ("Access-Control-Allow-Headers", "Range, If-Range, If-None-Match"),
+        ("Access-Control-Expose-Headers", "ETag, Accept-Ranges, Content-Range, Content-Length"),
+        ("Access-Control-Max-Age", "86400"),
+    ]
+
+    path = url.split('?')[0]
+    _, ext = os.path.splitext(path)
+    if ext.lower() in FORCE_DOWNLOAD_EXTENSIONS:
+        filename = os.path.basename(path)
+        # Simple quote handling
+        filename = filename.replace('"', '\\"')
+        headers.append(("Content-Disposition", f'attachment; filename="{filename}"'))
+    return headers
+
+
+def translate_url_path(url, root):
+    """
+    Map a request URL to a path under root, like
+    SimpleHTTPRequestHandler.translate_path: query and fragment are dropped
+    and components that aren't plain names (drives, "..") are ignored.
+    """
+    path = url.split('?', 1)[0]
+    path = path.split('#', 1)[0]
+    # Don't forget explicit trailing slash when normalizing. Issue17324
+    trailing_slash = path.rstrip().endswith('/')
+    try:
+        path = urllib.parse.unquote(path, errors='surrogatepass')
+    except UnicodeDecodeError:
+        path = urllib.parse.unquote(path)
+    path = posixpath.normpath(path)
+    result = root
+    for word in filter(None, path.split('/')):
+        if os.path.dirname(word) or word in (os.curdir, os.pardir):
+            continue
+        result = os.path.join(result, word)
+    if trailing_slash:
+        result += '/'
+    return result
+
+
+class Response:
+    """
+    A response built independently of the serving engine (threaded handler
+    or asyncio). The body is either bytes, or parts of an open file or of an
+    in-memory buffer (memoryview), given as (prefix_bytes, offset, length)
+    followed by trailer bytes, or an iterator of chunks of unknown total
+    length, which the engine sends with chunked transfer encoding (or, for
+    HTTP/1.0, by closing the connection at the end).
+    """
+    __slots__ = ("status", "headers", "body", "file", "buffer", "parts", "trailer", "chunks")
+
+    def __init__(self, status, headers=None, body=b"", file=None, buffer=None, parts=(), trailer=b"", chunks=None):
+        self.status = HTTPStatus(status)
+        self.headers = headers or []
+        self.body = body
+        self.file = file
+        self.buffer = buffer
+        self.parts = parts
+        self.trailer = trailer
+        self.chunks = chunks
+
+    @property
+    def has_body(self):
+        return bool(self.body) or self.file is not None or self.buffer is not None or self.chunks is not None
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.buffer = None
+        if self.chunks is not None:
+            if hasattr(self.chunks, "close"):
+                self.chunks.close()
+            self.chunks = None
+
+
+def chunked_encoding(chunks):
+    """
+    Frame an iterator of byte chunks for Transfer-Encoding: chunked. The
+    source isn't closed here; Response.close() does that, even if the body
+    is never sent (HEAD).
+    """
+    for chunk in chunks:
+        if chunk:
+            yield b"%x\r\n%s\r\n" % (len(chunk), chunk)
+    yield b"0\r\n\r\n"
+
+
+class ClosingChunks:
+    """
+    Chunks from a generator reading an open resource (such as a scandir
+    iterator). close() closes both, even if the generator never started
+    (HEAD), when a generator's own finally block wouldn't run.
+    """
+    __slots__ = ("chunks", "resource")
+
+    def __init__(self, chunks, resource):
+        self.chunks = chunks
+        self.resource = resource
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.chunks)
+
+    def close(self):
+        self.chunks.close()
+        if self.resource is not None:
+            self.resource.close()
+
+
+def json_response(payload, status=HTTPStatus.OK):
+    """Small JSON document built per request (not cached)."""
+    encoded = json.dumps(payload, indent=2).encode('utf-8')
+    return Response(status, [
+        ("Content-Type", "application/json; charset=utf-8"),
+        ("Content-Length", str(len(encoded))),
+        ("Cache-Control", "no-store"),
+    ], encoded)
+
+
+def accepted_encoding(header_value):
+    """Content coding to use given an Accept-Encoding header: "gzip", "deflate" or None."""
+    if not header_value:
+        return None
+    qvalues = {}
+    for item in header_value.split(","):
+        coding, _, params = item.partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[coding.strip().lower()] = q
+    default = qvalues.get("*", 0.0)
+    gzip_q, deflate_q = qvalues.get("gzip", default), qvalues.get("deflate", default)
+    if gzip_q > 0 and gzip_q >= deflate_q:
+        return "gzip"
+    return "deflate" if deflate_q > 0 else None
+
+
+def compress_response(response, headers, listing=None, listing_cache=None, display_path=None):
+    """
+    Compress a JSON response for clients that accept gzip or deflate. With a
+    listing, the compressed body is kept with it (keyed by the response's
+    ETag), so each version of a folder is compressed once per encoding.
+    Compressed responses get a weak ETag, as they aren't byte-identical.
+    """
+    if (response.status != HTTPStatus.OK or not response.body or len(response.body) < MIN_COMPRESS_BYTES
+            or ("Content-Type", "application/json; charset=utf-8") not in response.headers
+            or any(name == "Content-Encoding" for name, _ in response.headers)):
+        return response
+    response.headers.append(("Vary", "Accept-Encoding"))
+    encoding = accepted_encoding(headers.get("Accept-Encoding"))
+    if encoding is None:
+        return response
+
+    etag = next((value for name, value in response.headers if name == "ETag"), None)
+    key = (encoding, display_path, etag)
+    body = listing.compressed.get(key) if listing is not None and etag else None
+    if body is None:
+        if encoding == "gzip":
+            body = gzip.compress(response.body, COMPRESS_LEVEL, mtime=0)
+        else:
+            body = zlib.compress(response.body, COMPRESS_LEVEL)
+        if listing is not None and etag and len(listing.compressed) < MAX_LISTING_VIEWS:
+            listing.compressed[key] = body
+            if listing_cache is not None:
+                listing_cache.charge(listing, len(body))
+
+    response_headers = []
+    for name, value in response.headers:
+        if name == "Content-Length":
+            value = str(len(body))
+        elif name == "ETag":
+            value = "W/" + value
+        response_headers.append((name, value))
+    response_headers.append(("Content-Encoding", encoding))
+    return Response(response.status, response_headers, body)
+
+
+def error_response(status, message=None):
+    """HTML error page in the same format as BaseHTTPRequestHandler.send_error."""
+    status = HTTPStatus(status)
+    content = DEFAULT_ERROR_MESSAGE % {
+        'code': status.value,
+        'message': html.escape(message or status.phrase, quote=False),
+        'explain': html.escape(status.description, quote=False)
+    }
+    body = content.encode('UTF-8', 'replace')
+    return Response(status, [
+        ("Content-Type", DEFAULT_ERROR_CONTENT_TYPE),
+        ("Content-Length", str(len(body))),
+    ], body)
+
+
+def stats_response(server):
+    """Server, worker pool and cache counters."""
+    stats = {"server": server.stats() if hasattr(server, "stats") else {}}
+    listing_cache = getattr(server, "listing_cache", None)
+    if listing_cache is not None:
+        stats["listing_cache"] = listing_cache.stats()
+    tree_index = getattr(server, "tree_index", None)
+    if tree_index is not None:
+        stats["tree_index"] = tree_index.stats()
+    change_feed = getattr(server, "change_feed", None)
+    if change_feed is not None:
+        stats["change_feed"] = change_feed.stats()
+    listing_history = getattr(server, "listing_history", None)
+    if listing_history is not None:
+        stats["listing_history"] = listing_history.stats()
+    hot_cache = getattr(server, "hot_cache", None)
+    if hot_cache is not None:
+        stats["hot_cache"] = hot_cache.stats()
+    gzip_cache = getattr(server, "gzip_cache", None)
+    if gzip_cache is not None:
+        stats["gzip_cache"] = gzip_cache.stats()
+    return json_response(stats)
+
+
+def parse_search_time(value):
+    """Unix timestamp or ISO 8601 date/time (local time unless it has an offset)."""
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+def search_response(server, url, root):
+    """
+    Search the tree index: ?q= (name substring), ?ext=ppsx,pdf,
+    ?type=file|directory, ?modified_after= and ?modified_before= (timestamp
+    or ISO date), ?path= (limit to a folder) and ?limit=.
+    """
+    tree_index = getattr(server, "tree_index", None)
+    if tree_index is None:
+        return error_response(HTTPStatus.NOT_FOUND, "Search needs the server to run with --index")
+    if not tree_index.ready:
+        response = error_response(HTTPStatus.SERVICE_UNAVAILABLE, "The tree index is still being built")
+        response.headers.append(("Retry-After", "5"))
+        return response
+
+    params = urllib.parse.parse_qs(urllib.parse.urlsplit(url).query)
+
+    def param(name):
+        values = params.get(name)
+        return values[-1].strip() if values else ""
+
+    def param_set(name):
+        return {v.strip().lstrip('.').lower() for v in param(name).split(",") if v.strip()} or None
+
+    try:
+        limit = int(param("limit") or DEFAULT_SEARCH_LIMIT)
+        if not 0 < limit <= MAX_SEARCH_LIMIT:
+            raise ValueError(f"limit must be between 1 and {MAX_SEARCH_LIMIT}")
+        modified_after = parse_search_time(param("modified_after")) if param("modified_after") else None
+        modified_before = parse_search_time(param("modified_before")) if param("modified_before") else None
+    except ValueError as e:
+        return error_response(HTTPStatus.BAD_REQUEST, f"Bad search parameter: {e}")
+
+    under = None
+    if param("path"):
+        under = os.path.realpath(translate_url_path(urllib.parse.quote(param("path")), root))
+
+    started = time.perf_counter()
+    total, matches = tree_index.search(
+        query=param("q"),
+        extensions=param_set("ext"),
+        types=param_set("type"),
+        modified_after=modified_after,
+        modified_before=modified_before,
+        under=under,
+        limit=limit
+    )
+    files = []
+    for directory, record in matches:
+        entry = record.as_dict()
+        entry["path"] = tree_index.url_path(directory) + record.name
+        files.append(entry)
+    return json_response({
+        "query": {key: values[-1] for key, values in params.items()},
+        "total_matches": total,
+        "returned": len(files),
+        "search_ms": round((time.perf_counter() - started) * 1000, 3),
+        "files": files
+    })
+
+
+def get_listing(server, path):
+    """
+    Current CachedListing for a directory, from the tree index, the listing
+    cache or a fresh read, and the server's ListingCache, which holds and
+    charges it (None if caching is off). Raises OSError if the directory
+    can't be listed.
+    """
+    tree_index = getattr(server, "tree_index", None)
+    listing_cache = getattr(server, "listing_cache", None)
+    listing = tree_index.listing(path, listing_cache) if tree_index is not None else None
+    if listing is None:
+        if listing_cache is not None:
+            listing = listing_cache.get(path)
+        else:
+            listing = CachedListing(path, None, read_directory(path))
+    listing_history = getattr(server, "listing_history", None)
+    if listing_history is not None:
+        listing_history.observe(path, listing)
+    return listing, listing_cache
+
+
+class TreeWalk:
+    """The listings a recursive listing covers, in walk order, and how many entries it may still take."""
+    __slots__ = ("remaining", "truncated", "etags")
+
+    def __init__(self, max_entries):
+        self.remaining = max_entries
+        self.truncated = False
+        self.etags = []
+
+
+def plan_tree(server, path, display_path, depth, walk, listing=None):
+    """
+    Read path and its sub-folders down to depth. Returns (listing,
+    display_path, number of its entries included, {folder name: sub-plan}).
+    """
+    if listing is None:
+        listing, _ = get_listing(server, path)
+    walk.etags.append(listing.etag)
+    taken = 0
+    children = {}
+    for f in listing.files:
+        if walk.remaining <= 0:
+            walk.truncated = True
+            break
+        walk.remaining -= 1
+        taken += 1
+        if depth > 1 and f["type"] == "directory":
+            try:
+                children[f["name"]] = plan_tree(server, os.path.join(path, f["name"]),
+                                                display_path + f["name"] + "/", depth - 1, walk)
+            except OSError:
+                pass
+    return listing, display_path, taken, children
+
+
+def render_tree(plan):
+    """Listing entries for a plan_tree result, with sub-folder entries under "files"."""
+    listing, display_path, taken, children = plan
+    files = []
+    for f in listing.files[:taken]:
+        entry = dict(f, path=os.path.join(display_path, f["name"]).replace("//", "/"))
+        child = children.get(f["name"])
+        if child is not None:
+            entry["files"] = render_tree(child)
+        files.append(entry)
+    return files
+
+
+def tree_response(server, path, display_path, headers, depth):
+    """
+    Recursive JSON listing down to depth levels. The encoded tree is kept
+    with the top folder's listing and reused while none of the folders it
+    covers has changed; its ETag is derived from theirs.
+    """
+    walk = TreeWalk(MAX_TREE_ENTRIES)
+    try:
+        listing, listing_cache = get_listing(server, path)
+        plan = plan_tree(server, path, display_path, depth, walk, listing)
+    except OSError:
+        return error_response(HTTPStatus.NOT_FOUND, "No permission to list directory")
+    etag = '"tree-' + hashlib.sha1(f"{depth}\n{walk.truncated}\n{''.join(walk.etags)}".encode()).hexdigest() + '"'
+
+    if etag_matches(headers.get("If-None-Match"), etag):
+        return Response(HTTPStatus.NOT_MODIFIED, [
+            ("ETag", etag),
+            ("Cache-Control", "no-cache"),
+        ])
+
+    key = ("tree", display_path, depth)
+    cached = listing.bodies.get(key)
+    if cached is not None and cached[0] == etag:
+        encoded = cached[1]
+    else:
+        files = render_tree(plan)
+        encoded = json.dumps({
+            "directory": display_path,
+            "depth": depth,
+            "total_items": MAX_TREE_ENTRIES - walk.remaining,
+            "truncated": walk.truncated,
+            "generated_at": datetime.now().isoformat(),
+            "files": files
+        }, indent=2).encode('utf-8')
+        if len(encoded) > MAX_TREE_BYTES:
+            # Remember that this version is too large rather than the body
+            encoded = None
+        listing.bodies[key] = (etag, encoded)
+        if listing_cache is not None:
+            replaced = len(cached[1] or b"") if cached is not None else 0
+            listing_cache.charge(listing, len(encoded or b"") - replaced)
+
+    if encoded is None:
+        return error_response(HTTPStatus.BAD_REQUEST,
+                              f"Tree listing is larger than {MAX_TREE_BYTES // (1024 * 1024)} MB; use a smaller depth")
+    return compress_response(Response(HTTPStatus.OK, [
+        ("Content-Type", "application/json; charset=utf-8"),
+        ("Content-Length", str(len(encoded))),
+        ("ETag", etag),
+        ("Cache-Control", "no-cache"),
+    ], encoded), headers, listing, listing_cache, display_path)
+
+
+def batch_response(server, url, headers, root):
+    """
+    Listings for several folders (?path=/a/&path=/b/...) in one JSON
+    document. Folders are read concurrently on the server's batch pool; each
+    listing is the same cached body a single request would get. Folders that
+    can't be listed get an "error" entry instead.
+    """
+    params = urllib.parse.parse_qs(urllib.parse.urlsplit(url).query)
+    display_paths = [p.strip() for p in params.get("path", []) if p.strip()]
+    if not display_paths:
+        return error_response(HTTPStatus.BAD_REQUEST, "Give at least one ?path=")
+    if len(display_paths) > MAX_BATCH_PATHS:
+        return error_response(HTTPStatus.BAD_REQUEST, f"At most {MAX_BATCH_PATHS} paths per batch")
+    display_paths = ["/" + p.strip("/") + "/" if p.strip("/") else "/" for p in display_paths]
+
+    def load(display_path):
+        path = translate_url_path(urllib.parse.quote(display_path), root)
+        try:
+            return get_listing(server, path)
+        except OSError:
+            return None, None
+
+    batch_pool = getattr(server, "batch_pool", None)
+    if batch_pool is not None and len(display_paths) > 1:
+        results = list(batch_pool.map(load, display_paths))
+    else:
+        results = [load(p) for p in display_paths]
+
+    digest = hashlib.sha1()
+    for display_path, (listing, _) in zip(display_paths, results):
+        digest.update(f"{display_path}\0{listing.etag if listing is not None else '-'}\n".encode('utf-8', 'surrogateescape'))
+    etag = f'"batch-{digest.hexdigest()}"'
+    if etag_matches(headers.get("If-None-Match"), etag):
+        return Response(HTTPStatus.NOT_MODIFIED, [
+            ("ETag", etag),
+            ("Cache-Control", "no-cache"),
+        ])
+
+    bodies = []
+    for display_path, (listing, listing_cache) in zip(display_paths, results):
+        if listing is None:
+            bodies.append(json.dumps({"directory": display_path, "error": "Folder not found or can't be listed"}).encode('utf-8'))
+        elif listing_cache is not None:
+            bodies.append(listing_cache.render(listing, display_path))
+        else:
+            bodies.append(listing.render(display_path))
+    encoded = b'{"directories": [\n' + b",\n".join(bodies) + b"\n]}"
+    return Response(HTTPStatus.OK, [
+        ("Content-Type", "application/json; charset=utf-8"),
+        ("Content-Length", str(len(encoded))),
+        ("ETag", etag),
+        ("Cache-Control", "no-cache"),
+    ], encoded)
+
+
+class ListingQuery:
+    """
+    Listing options from the query string: page size, the cursor of the page
+    to start after, sort order, extension/type filters and which entry
+    fields to include.
+    """
+    __slots__ = ("limit", "cursor", "sort", "descending", "extensions", "types", "fields", "compact")
+
+    # Query parameters that select a listing view instead of the whole listing
+    PARAMS = ("limit", "cursor", "sort", "order", "ext", "type", "fields", "compact")
+    SORTS = {"mtime": True, "size": True, "name": False}  # sort -> descending by default
+    TYPES = {"file", "directory", "symlink"}
+    FIELDS = ("name", "extension", "type", "size_bytes", "modified_timestamp", "modified_iso", "path")
+    # Compact listings leave out what clients can derive from the rest
+    COMPACT_FIELDS = ("name", "type", "size_bytes", "modified_timestamp")
+
+    def __init__(self, params):
+        """Parse parse_qs() output; raises ValueError for bad values."""
+        def param(name):
+            values = params.get(name)
+            return values[-1].strip() if values else ""
+
+        self.limit = None
+        if param("limit"):
+            self.limit = int(param("limit"))
+            if not 1 <= self.limit <= MAX_LISTING_LIMIT:
+                raise ValueError(f"limit must be between 1 and {MAX_LISTING_LIMIT}")
+        self.cursor = param("cursor") or None
+        if self.cursor is not None and self.limit is None:
+            raise ValueError("cursor needs limit")
+
+        self.sort = param("sort").lower() or "mtime"
+        if self.sort not in self.SORTS:
+            raise ValueError(f"sort must be one of {', '.join(self.SORTS)}")
+        order = param("order").lower()
+        if order not in ("", "asc", "desc"):
+            raise ValueError("order must be asc or desc")
+        self.descending = order == "desc" if order else self.SORTS[self.sort]
+
+        def param_set(name):
+            values = {v.strip().lstrip('.').lower() for v in param(name).split(",") if v.strip()}
+            return tuple(sorted(values)) or None
+
+        self.extensions = param_set("ext")
+        self.types = param_set("type")
+        if self.types is not None and not self.TYPES.issuperset(self.types):
+            raise ValueError(f"type must be one or more of {', '.join(sorted(self.TYPES))}")
+
+        compact = param("compact").lower()
+        if compact not in ("", "0", "1", "true", "false"):
+            raise ValueError("compact must be 1 or 0")
+        self.compact = compact in ("1", "true")
+        fields = {v.strip() for v in param("fields").split(",") if v.strip()}
+        unknown = fields.difference(self.FIELDS)
+        if unknown:
+            raise ValueError(f"unknown field {sorted(unknown)[0]}; fields are {', '.join(self.FIELDS)}")
+        if fields:
+            # Always in listing order, so equivalent requests share a cache entry
+            self.fields = tuple(f for f in self.FIELDS if f in fields)
+        else:
+            self.fields = self.COMPACT_FIELDS if self.compact else self.FIELDS
+
+    def view_key(self):
+        """Identifies the ordered, filtered entries this query pages through."""
+        return (self.sort, self.descending, self.extensions, self.types)
+
+    def key(self, start):
+        """Identifies the encoded view, given the offset the page starts at."""
+        return ("view", start, self.limit) + self.view_key() + (self.fields, self.compact)
+
+    def sort_value(self, f):
+        """The value entries are ordered by, for cursors."""
+        if self.sort == "size":
+            return f["size_bytes"]
+        if self.sort == "name":
+            return f["name"].casefold()
+        return f["modified_timestamp"]
+
+    def order_key(self, value, name):
+        """
+        Key that orders entries as CachedListing.order does, from an entry's
+        sort value and name. Entries with the same mtime keep folder order,
+        so for mtime it is the time alone.
+        """
+        if self.sort == "size":
+            return (value, name.casefold(), name)
+        if self.sort == "name":
+            return (value, name)
+        return (value,)
+
+    def matches(self, f):
+        """Whether an entry passes the extension and type filters."""
+        return ((self.extensions is None or f["extension"] in self.extensions)
+                and (self.types is None or f["type"] in self.types))
+
+    def project(self, f, display_path):
+        """The entry with only the requested fields."""
+        entry = {}
+        for field in self.fields:
+            entry[field] = os.path.join(display_path, f["name"]).replace("//", "/") if field == "path" else f[field]
+        return entry
+
+    def entries(self, listing, listing_cache=None):
+        """The listing's entries in this query's order, filtered; cached with the listing."""
+        view_key = self.view_key()
+        if view_key == ("mtime", True, None, None):
+            return listing.files
+        entries = listing.views.get(view_key)
+        if entries is None:
+            files = listing.files
+            entries = [files[i] for i in listing.order(self.sort, self.descending) if self.matches(files[i])]
+            if len(listing.views) < MAX_LISTING_VIEWS:
+                listing.views[view_key] = entries
+                if listing_cache is not None:
+                    listing_cache.charge(listing, 8 * len(entries) + 64)
+        return entries
+
+
+def listing_version(listing):
+    """Short form of a listing's ETag, carried in cursors and delta listings."""
+    return listing.etag.strip('"')[:12]
+
+
+def delta_response(server, path, display_path, listing, listing_cache, headers, since):
+    """
+    Entries added, modified and removed since a version of the folder
+    (?since=<version or ETag>) or a time (?since=<timestamp>), from the
+    server's listing history. When that version isn't known any more, the
+    whole listing comes back as "added" with "reset": true. Encoded deltas
+    are kept with the listing, as the same poll tends to come from many
+    clients.
+    """
+    token = since.strip()
+    if token.startswith("W/"):
+        token = token[2:]
+    token = token.strip('"').lower()
+    if len(token) in (12, 40) and all(c in "0123456789abcdef" for c in token):
+        version, at = token[:12], None
+    else:
+        try:
+            version, at = None, parse_search_time(since)
+        except ValueError:
+            return error_response(HTTPStatus.BAD_REQUEST, "since must be a listing version (ETag) or a time")
+
+    listing_history = getattr(server, "listing_history", None)
+    base = listing_history.find(path, version, at) if listing_history is not None else None
+    base_version = base[0] if base is not None else None
+    if listing_history is not None:
+        listing_history.count(base is None)
+
+    etag = '"' + listing.etag.strip('"') + "-since-" + (base_version or "reset") + '"'
+    if etag_matches(headers.get("If-None-Match"), etag):
+        return Response(HTTPStatus.NOT_MODIFIED, [
+            ("ETag", etag),
+            ("Cache-Control", "no-cache"),
+        ])
+
+    key = ("since", display_path, base_version)
+    encoded = listing.bodies.get(key)
+    if encoded is None:
+        def entry(f):
+            return dict(f, path=os.path.join(display_path, f["name"]).replace("//", "/"))
+
+        added, modified = [], []
+        removed = []
+        if base is None:
+            added = [entry(f) for f in listing.files]
+        elif base[1] is not listing.files:
+            previous = {f["name"]: f for f in base[1]}
+            for f in listing.files:
+                old = previous.pop(f["name"], None)
+                if old is None:
+                    added.append(entry(f))
+                elif old != f:
+                    modified.append(entry(f))
+            removed = list(previous)
+        encoded = json.dumps({
+            "directory": display_path,
+            "version": listing_version(listing),
+            "since_version": base_version,
+            "reset": base is None,
+            "generated_at": listing.generated_at,
+            "added": added,
+            "modified": modified,
+            "removed": removed
+        }, indent=2).encode('utf-8')
+        if len(listing.bodies) < MAX_LISTING_VIEWS:
+            listing.bodies[key] = encoded
+            if listing_cache is not None:
+                listing_cache.charge(listing, len(encoded))
+
+    return Response(HTTPStatus.OK, [
+        ("Content-Type", "application/json; charset=utf-8"),
+        ("Content-Length", str(len(encoded))),
+        ("ETag", etag),
+        ("Cache-Control", "no-cache"),
+    ], encoded)
+
+
+def view_fingerprint(query):
+    return hashlib.sha1(repr(query.view_key()).encode('utf-8')).hexdigest()[:8]
+
+
+def encode_cursor(listing, query, offset, last):
+    """Opaque cursor for the page that starts at offset, after entry last."""
+    data = {"o": offset, "v": listing_version(listing), "q": view_fingerprint(query),
+            "k": query.sort_value(last), "n": last["name"]}
+    return base64.urlsafe_b64encode(json.dumps(data, separators=(",", ":")).encode('utf-8')).decode('ascii').rstrip("=")
+
+
+def decode_cursor(cursor, listing, query, files):
+    """
+    Offset in files where the page after cursor starts. If the folder
+    changed since the cursor was issued, paging continues after the last
+    entry the client saw rather than at the old offset. If that entry is
+    gone, entries tied with it that can't be told apart (same mtime) are
+    sent again rather than skipped.
+    """
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        offset, version, view, last_value, name = int(data["o"]), data["v"], data["q"], data["k"], str(data["n"])
+    except (ValueError, KeyError, TypeError):
+        raise ValueError("invalid cursor")
+    if view != view_fingerprint(query):
+        raise ValueError("cursor belongs to a listing with other sort or filter options")
+    if version == listing_version(listing):
+        return min(max(offset, 0), len(files))
+    last = query.order_key(last_value, name)
+    ties = None
+    for i, f in enumerate(files):
+        value = query.sort_value(f)
+        if f["name"] == name and value == last_value:
+            return i + 1
+        key = query.order_key(value, f["name"])
+        try:
+            if key == last:
+                if ties is None:
+                    ties = i
+            elif (key < last) if query.descending else (key > last):
+                return i if ties is None else ties
+        except TypeError:
+            raise ValueError("invalid cursor")
+    return len(files) if ties is None else ties
+
+
+def render_entries(listing, listing_cache, display_path, query, page):
+    """
+    Encoded JSON for each entry of page, projected to query.fields. Encoded
+    entries are kept with the listing, so every page, sort order and filter
+    of a folder version encodes each entry at most once per field set.
+    """
+    fields = query.fields
+    key = (fields, query.compact, display_path if "path" in fields else None)
+    fragments = listing.fragments.get(key)
+    if fragments is None:
+        fragments = {}
+        if len(listing.fragments) < MAX_LISTING_VIEWS:
+            listing.fragments[key] = fragments
+
+    encoded = []
+    added = 0
+    for f in page:
+        fragment = fragments.get(f["name"])
+        if fragment is None:
+            entry = query.project(f, display_path)
+            if query.compact:
+                fragment = json.dumps(entry, separators=(",", ":")).encode('utf-8')
+            else:
+                # Indented to sit in the "files" array of an indent=2 body
+                fragment = b"    " + json.dumps(entry, indent=2).replace("\n", "\n    ").encode('utf-8')
+            fragments[f["name"]] = fragment
+            added += len(fragment) + 64
+        encoded.append(fragment)
+    if added and listing_cache is not None and listing.fragments.get(key) is fragments:
+        listing_cache.charge(listing, added)
+    return encoded
+
+
+def encode_view(header, fragments, compact):
+    """JSON body for header with the already encoded entries as its "files" array."""
+    if compact:
+        head = json.dumps(header, separators=(",", ":")).encode('utf-8')
+        return head[:-1] + b',"files":[' + b",".join(fragments) + b"]}"
+    head = json.dumps(header, indent=2).encode('utf-8')
+    if not fragments:
+        return head[:-2] + b',\n  "files": []\n}'
+    return head[:-2] + b',\n  "files": [\n' + b",\n".join(fragments) + b"\n  ]\n}"
+
+
+def listing_view_response(listing, listing_cache, display_path, headers, query):
+    """
+    A sorted, filtered, projected and/or paged view of a cached listing.
+    Pages are cut from the view's entries, which are ordered with the
+    listing's cached sort permutation, and assembled from cached encoded
+    entries; each encoded page is kept with the listing (up to
+    MAX_LISTING_VIEWS of them) until the folder changes.
+    """
+    files = query.entries(listing, listing_cache)
+    try:
+        start = decode_cursor(query.cursor, listing, query, files) if query.cursor else 0
+    except ValueError as e:
+        return error_response(HTTPStatus.BAD_REQUEST, str(e))
+
+    key = query.key(start)
+    etag = '"' + listing.etag.strip('"') + "-" + hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:12] + '"'
+    if etag_matches(headers.get("If-None-Match"), etag):
+        return Response(HTTPStatus.NOT_MODIFIED, [
+            ("ETag", etag),
+            ("Cache-Control", "no-cache"),
+        ])
+
+    body_key = (display_path,) + key
+    encoded = listing.bodies.get(body_key)
+    if encoded is None:
+        end = start + query.limit if query.limit is not None else len(files)
+        page = files[start:end]
+        next_cursor = encode_cursor(listing, query, end, page[-1]) if page and end < len(files) else None
+        encoded = encode_view({
+            "directory": display_path,
+            "total_items": len(files),
+            "generated_at": listing.generated_at,
+            "sort": query.sort,
+            "order": "desc" if query.descending else "asc",
+            "offset": start,
+            "limit": query.limit,
+            "next_cursor": next_cursor,
+        }, render_entries(listing, listing_cache, display_path, query, page), query.compact)
+        if len(listing.bodies) < MAX_LISTING_VIEWS:
+            listing.bodies[body_key] = encoded
+            if listing_cache is not None:
+                listing_cache.charge(listing, len(encoded))
+
+    return Response(HTTPStatus.OK, [
+        ("Content-Type", "application/json; charset=utf-8"),
+        ("Content-Length", str(len(encoded))),
+        ("ETag", etag),
+        ("Cache-Control", "no-cache"),
+    ], encoded)
+
+
+def ndjson_response(server, path, display_path, params):
+    """
+    Listing streamed as one JSON object per line (?format=ndjson), sent as
+    the entries are read, so the first bytes go out at once and memory use
+    doesn't grow with the folder. Entries come in folder order (newest
+    first if the folder is in the tree index). ?ext=, ?type=, ?fields= and
+    ?compact=1 apply; sorting and paging need the whole listing.
+    """
+    unsupported = [name for name in ("sort", "order", "limit", "cursor", "depth", "since") if name in params]
+    if unsupported:
+        return error_response(HTTPStatus.BAD_REQUEST, f"format=ndjson can't be combined with ?{unsupported[0]}=")
+    try:
+        query = ListingQuery(params)
+    except ValueError as e:
+        return error_response(HTTPStatus.BAD_REQUEST, f"Bad listing parameter: {e}")
+
+    tree_index = getattr(server, "tree_index", None)
+    try:
+        node = tree_index.directory(path) if tree_index is not None else None
+    except OSError:
+        return error_response(HTTPStatus.NOT_FOUND, "No permission to list directory")
+    if node is not None:
+        entries, it = (record.as_dict() for record in node.entries), None
+    else:
+        try:
+            it = os.scandir(path)
+        except OSError:
+            return error_response(HTTPStatus.NOT_FOUND, "No permission to list directory")
+        entries = (record.as_dict() for record in scan_entries(it))
+
+    def lines():
+        chunk = []
+        size = 0
+        sent = False
+        try:
+            for f in entries:
+                if not query.matches(f):
+                    continue
+                line = json.dumps(query.project(f, display_path), separators=(",", ":")).encode('utf-8') + b"\n"
+                chunk.append(line)
+                size += len(line)
+                if size >= NDJSON_CHUNK_BYTES or not sent:
+                    yield b"".join(chunk)
+                    chunk = []
+                    size = 0
+                    sent = True
+            if chunk:
+                yield b"".join(chunk)
+        except OSError as e:
+            logger.warning(f"Streamed listing of {path} failed: {e}")
+            raise
+
+    return Response(HTTPStatus.OK, [
+        ("Content-Type", "application/x-ndjson; charset=utf-8"),
+        ("Cache-Control", "no-cache"),
+    ], chunks=ClosingChunks(lines(), it))
+
+
+def listing_response(server, path, url, headers):
+    """
+    JSON directory listing, answered with 304 when the client's ETag
+    matches. ?depth=N (2 or more) includes sub-folders recursively;
+    ?sort=, ?order=, ?ext= and ?type= reorder and filter it, ?fields= and
+    ?compact=1 trim its entries, and ?limit= and ?cursor= page through it.
+    ?format=ndjson streams it instead, and ?since= returns only what
+    changed since a version or time.
+    """
+    display_path = urllib.parse.unquote(urllib.parse.urlsplit(url).path)
+    params = urllib.parse.parse_qs(urllib.parse.urlsplit(url).query)
+    if "format" in params:
+        listing_format = params["format"][-1].strip().lower()
+        if listing_format == "ndjson":
+            return ndjson_response(server, path, display_path, params)
+        if listing_format != "json":
+            return error_response(HTTPStatus.BAD_REQUEST, "format must be json or ndjson")
+    if "since" in params:
+        unsupported = [name for name in ListingQuery.PARAMS + ("depth",) if name in params]
+        if unsupported:
+            return error_response(HTTPStatus.BAD_REQUEST, f"since can't be combined with ?{unsupported[0]}=")
+    if "depth" in params:
+        try:
+            depth = int(params["depth"][-1])
+            if not 1 <= depth <= MAX_TREE_DEPTH:
+                raise ValueError
+        except ValueError:
+            return error_response(HTTPStatus.BAD_REQUEST, f"depth must be between 1 and {MAX_TREE_DEPTH}")
+        if depth > 1:
+            return tree_response(server, path, display_path, headers, depth)
+
+    query = None
+    if any(name in params for name in ListingQuery.PARAMS):
+        try:
+            query = ListingQuery(params)
+        except ValueError as e:
+            return error_response(HTTPStatus.BAD_REQUEST, f"Bad listing parameter: {e}")
+
+    try:
+        listing, listing_cache = get_listing(server, path)
+    except OSError:
+        return error_response(HTTPStatus.NOT_FOUND, "No permission to list directory")
+
+    if "since" in params:
+        return compress_response(delta_response(server, path, display_path, listing, listing_cache, headers,
+                                                params["since"][-1]),
+                                 headers, listing, listing_cache, display_path)
+
+    if query is not None:
+        return compress_response(listing_view_response(listing, listing_cache, display_path, headers, query),
+                                 headers, listing, listing_cache, display_path)
+
+    if etag_matches(headers.get("If-None-Match"), listing.etag):
+        return Response(HTTPStatus.NOT_MODIFIED, [
+            ("ETag", listing.etag),
+            ("Cache-Control", "no-cache"),
+        ])
+
+    if listing_cache is not None:
+        encoded = listing_cache.render(listing, display_path)
+    else:
+        encoded = listing.render(display_path)
+
+    return compress_response(Response(HTTPStatus.OK, [
+        ("Content-Type", "application/json; charset=utf-8"),
+        ("Content-Length", str(len(encoded))),
+        ("ETag", listing.etag),
+        ("Cache-Control", "no-cache"),
+    ], encoded), headers, listing, listing_cache, display_path)
+
+
+def not_modified(headers, stat_info, etag):
+    """Evaluate If-None-Match, or If-Modified-Since when no ETag was sent."""
+    if "If-None-Match" in headers:
+        return etag_matches(headers["If-None-Match"], etag)
+    if "If-Modified-Since" not in headers:
+        return False
+    try:
+        ims = email.utils.parsedate_to_datetime(headers["If-Modified-Since"])
+    except (TypeError, IndexError, OverflowError, ValueError):
+        # ignore ill-formed values
+        return False
+    if ims.tzinfo is None:
+        ims = ims.replace(tzinfo=timezone.utc)
+    last_modif = datetime.fromtimestamp(int(stat_info.st_mtime), timezone.utc)
+    return last_modif <= ims
+
+
+def gzip_file_response(path, stat_info, headers, ctype, gzip_cache):
+    """
+    The file's compressed copy from gzip_cache, for clients that accept gzip
+    and didn't ask for a range; None to send the file as it is.
+    """
+    if "Range" in headers or accepted_encoding(headers.get("Accept-Encoding")) != "gzip":
+        return None
+    f = gzip_cache.open(path, stat_info)
+    if f is None:
+        return None
+    etag = file_etag(stat_info)
+    if not_modified(headers, stat_info, etag):
+        f.close()
+        return Response(HTTPStatus.NOT_MODIFIED, [("ETag", "W/" + etag), ("Vary", "Accept-Encoding")])
+    size = os.fstat(f.fileno()).st_size
+    return Response(HTTPStatus.OK, [
+        ("Content-type", ctype),
+        ("Content-Length", str(size)),
+        ("Content-Encoding", "gzip"),
+        ("Vary", "Accept-Encoding"),
+        ("ETag", "W/" + etag),
+        ("Last-Modified", email.utils.formatdate(stat_info.st_mtime, usegmt=True)),
+    ], file=f, parts=[(b"", 0, size)])
+
+
+def file_response(path, headers, hot_cache=None, gzip_cache=None):
+    """
+    Serve a file, honouring If-None-Match, If-Modified-Since and single or
+    multiple byte ranges (206, with If-Range validation). Popular files are
+    served from hot_cache without opening them, and compressible ones from
+    their gzip_cache copy when the client accepts gzip.
+    """
+    ctype = guess_mime_type(path)
+    f = None
+    buffer = None
+    compressible = False
+    try:
+        if hot_cache is not None or gzip_cache is not None:
+            fs = os.stat(path)
+            compressible = gzip_cache is not None and gzip_cache.eligible(path, fs)
+            if compressible:
+                response = gzip_file_response(path, fs, headers, ctype, gzip_cache)
+                if response is not None:
+                    return response
+            if hot_cache is not None:
+                buffer = hot_cache.get(path, fs)
+        if buffer is None:
+            f = open(path, 'rb')
+            fs = os.fstat(f.fileno())
+    except OSError:
+        if f is not None:
+            f.close()
+        return error_response(HTTPStatus.NOT_FOUND, "File not found")
+
+    try:
+        size = fs.st_size
+        etag = file_etag(fs)
+        last_modified = email.utils.formatdate(fs.st_mtime, usegmt=True)
+
+        if not_modified(headers, fs, etag):
+            if f is not None:
+                f.close()
+            return Response(HTTPStatus.NOT_MODIFIED, [("ETag", etag)])
+
+        ranges = None
+        if if_range_matches(headers.get("If-Range"), etag, last_modified):
+            ranges = parse_range_header(headers.get("Range"), size)
+
+        if ranges == []:
+            if f is not None:
+                f.close()
+            return Response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE, [
+                ("Content-Range", f"bytes */{size}"),
+                ("Content-Length", "0"),
+            ])
+
+        if ranges is None:
+            response = Response(HTTPStatus.OK, [
+                ("Content-type", ctype),
+                ("Content-Length", str(size)),
+            ], file=f, buffer=buffer, parts=[(b"", 0, size)])
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            response = Response(HTTPStatus.PARTIAL_CONTENT, [
+                ("Content-type", ctype),
+                ("Content-Range", f"bytes {start}-{end}/{size}"),
+                ("Content-Length", str(end - start + 1)),
+            ], file=f, buffer=buffer, parts=[(b"", start, end - start + 1)])
+        else:
+            multipart_type, parts, trailer, length = multipart_byteranges(ranges, ctype, size)
+            response = Response(HTTPStatus.PARTIAL_CONTENT, [
+                ("Content-type", multipart_type),
+                ("Content-Length", str(length)),
+            ], file=f, buffer=buffer, parts=parts, trailer=trailer)
+
+        response.headers += [
+            ("Accept-Ranges", "bytes"),
+            ("ETag", etag),
+            ("Last-Modified", last_modified),
+        ]
+        if compressible:
+            response.headers.append(("Vary", "Accept-Encoding"))
+        return response
+    except:
+        if f is not None:
+            f.close()
+        raise
+
+
+def events_response(server, url, headers, root):
+    """
+    Server-Sent Events stream of changes to a folder and its sub-folders
+    (?path=/folder/, default the whole tree), as seen by the tree index:
+    one "change" event per changed folder, with its new listing version for
+    ?since=. Sends Last-Event-ID's missed events first, or a "reset" event
+    if they're no longer kept.
+    """
+    change_feed = getattr(server, "change_feed", None)
+    if change_feed is None:
+        return error_response(HTTPStatus.NOT_FOUND, "Change events need the tree index (--index)")
+    params = urllib.parse.parse_qs(urllib.parse.urlsplit(url).query)
+    display_path = params.get("path", ["/"])[-1].strip() or "/"
+    path = os.path.realpath(translate_url_path(urllib.parse.quote(display_path), root))
+    tree_root = change_feed.tree_index.root
+    if not os.path.isdir(path) or (path != tree_root and not path.startswith(tree_root.rstrip(os.sep) + os.sep)):
+        return error_response(HTTPStatus.NOT_FOUND, "Folder not found or not indexed")
+
+    subscriber = change_feed.subscribe(path, (headers.get("Last-Event-ID") or "").strip() or None)
+    if subscriber is None:
+        return Response(HTTPStatus.SERVICE_UNAVAILABLE, [
+            ("Retry-After", str(EVENTS_HEARTBEAT_SECONDS)),
+            ("Content-Length", "0"),
+        ])
+    return Response(HTTPStatus.OK, [
+        ("Content-Type", "text/event-stream; charset=utf-8"),
+        ("Cache-Control", "no-cache"),
+    ], chunks=subscriber)
+
+
+def build_response(server, url, headers, root):
+    """
+    Route a GET/HEAD request: server stats, directory redirect, index.html,
+    JSON listing or file. Mirrors SimpleHTTPRequestHandler.send_head.
+    """
+    url_path = urllib.parse.urlsplit(url).path
+    if url_path == STATS_PATH:
+        return compress_response(stats_response(server), headers)
+    if url_path == SEARCH_PATH:
+        return compress_response(search_response(server, url, root), headers)
+    if url_path == BATCH_PATH:
+        return compress_response(batch_response(server, url, headers, root), headers)
+    if url_path == EVENTS_PATH:
+        return events_response(server, url, headers, root)
+
+    path = translate_url_path(url, root)
+    if os.path.isdir(path):
+        parts = urllib.parse.urlsplit(url)
+        if not parts.path.endswith('/'):
+            # redirect browser - doing basically what apache does
+            new_parts = (parts[0], parts[1], parts[2] + '/', parts[3], parts[4])
+            return Response(HTTPStatus.MOVED_PERMANENTLY, [
+                ("Location", urllib.parse.urlunsplit(new_parts)),
+                ("Content-Length", "0"),
+            ])
+        for index in "index.html", "index.htm":
+            index = os.path.join(path, index)
+            if os.path.isfile(index):
+                path = index
+                break
+        else:
+            return listing_response(server, path, url, headers)
+    # Paths with a trailing "/" that aren't directories are not found (Issue17324)
+    if path.endswith("/"):
+        return error_response(HTTPStatus.NOT_FOUND, "File not found")
+    return file_response(path, headers, getattr(server, "hot_cache", None), getattr(server, "gzip_cache", None))
+
+
+class DirectoryHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        """Override to use our logger."""
+        logger.info("%s - %s" % (self.address_string(), format % args))
+
+    def setup(self):
+        """Switch to HTTP/1.1 persistent connections when the server enables keep-alive."""
+        self.requests_handled = 0
+        self.keep_alive_timeout = getattr(self.server, "keep_alive_timeout", DEFAULT_KEEP_ALIVE_TIMEOUT_SECONDS)
+        self.keep_alive_max = getattr(self.server, "keep_alive_max", DEFAULT_KEEP_ALIVE_MAX_REQUESTS)
+        if getattr(self.server, "keep_alive", False):
+            self.protocol_version = "HTTP/1.1"
+        if isinstance(self.request, ssl.SSLSocket):
+            # The listening socket doesn't handshake on accept, so a slow or
+            # stalled client only ties up this connection's worker
+            self.request.settimeout(TLS_HANDSHAKE_TIMEOUT_SECONDS)
+            self.request.do_handshake()
+            self.request.settimeout(None)
+            tls = getattr(self.server, "tls", None)
+            if tls is not None:
+                if tls.ktls:
+                    self.ktls_send = ktls_send_active(self.request)
+                tls.record_handshake(self.request, self.ktls_send if tls.ktls else None)
+        super().setup()
+
+    def handle_one_request(self):
+        """
+        Handle one request. Wait at most REQUEST_READ_TIMEOUT_SECONDS for a new
+        connection's first request (keep_alive_timeout between requests on a
+        kept-alive one) and close quietly if none arrives. The request line and
+        headers must also arrive within REQUEST_READ_TIMEOUT_SECONDS.
+        """
+        try:
+            self.connection.settimeout(self.keep_alive_timeout if self.requests_handled else REQUEST_READ_TIMEOUT_SECONDS)
+            if not self.rfile.peek(1):
+                self.close_connection = True
+                return
+            self.connection.settimeout(REQUEST_READ_TIMEOUT_SECONDS)
+        except OSError:
+            self.close_connection = True
+            return
+        super().handle_one_request()
+        self.requests_handled += 1
+
+    def parse_request(self):
+        """Lift the request read timeout once the headers are in, before the response is written."""
+        result = super().parse_request()
+        self.connection.settimeout(self.timeout)
+        return result
+
+    def send_error(self, code, message=None, explain=None):
+        """
+        Same as BaseHTTPRequestHandler.send_error, but keeps a persistent
+        connection open after ordinary client errors (404 and the like) on
+        body-less requests, instead of always closing it.
+        """
+        try:
+            shortmsg, longmsg = self.responses[code]
+        except KeyError:
+            shortmsg, longmsg = '???', '???'
+        if message is None:
+            message = shortmsg
+        if explain is None:
+            explain = longmsg
+        self.log_error("code %d, message %s", code, message)
+        self.send_response(code, message)
+        if (code >= 500 or code in (400, 408, 413, 414, 431)
+                or self.command not in ("GET", "HEAD", "OPTIONS")):
+            self.send_header('Connection', 'close')
+
+        # Message body is omitted for 1xx, 204, 205 and 304
+        body = None
+        if (code >= 200 and
+            code not in (HTTPStatus.NO_CONTENT,
+                         HTTPStatus.RESET_CONTENT,
+                         HTTPStatus.NOT_MODIFIED)):
+            content = (self.error_message_format % {
+                'code': code,
+                'message': html.escape(message, quote=False),
+                'explain': html.escape(explain, quote=False)
+            })
+            body = content.encode('UTF-8', 'replace')
+            self.send_header("Content-Type", self.error_content_type)
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        if self.command != 'HEAD' and body:
+            self.wfile.write(body)
+
+    def end_headers(self):
+        """Add CORS, keep-alive and Content-Disposition headers to every response."""
+        if self.protocol_version >= "HTTP/1.1" and not self.close_connection:
+            if self.requests_handled + 1 >= self.keep_alive_max:
+                self.send_header("Connection", "close")
+            else:
+                if self.request_version == "HTTP/1.0":
+                    self.send_header("Connection", "keep-alive")
+                remaining = self.keep_alive_max - self.requests_handled - 1
+                self.send_header("Keep-Alive", f"timeout={int(self.keep_alive_timeout)}, max={remaining}")
+
+        for name, value in common_headers(self.path):
+            self.send_header(name, value)
+        super().end_headers()
+
+    def do_OPTIONS(self):
+        """Handle preflight requests."""
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    # socket.sendfile only avoids user-space copies where os.sendfile exists;
+    # elsewhere (Windows) it degrades to 8 KB sends, slower than copy_range
+    use_sendfile = hasattr(os, "sendfile")
+    ktls_send = False
+
+    def send_head(self):
+        """Common code for GET and HEAD: build the response and send its headers."""
+        return self.send_prepared(build_response(self.server, self.path, self.headers, self.directory))
+
+    def send_prepared(self, response):
+        """Send a Response's status line and headers; return it if it has a body to copy."""
+        self.send_response(response.status)
+        for name, value in response.headers:
+            self.send_header(name, value)
+        self.chunked = False
+        if response.chunks is not None and self.protocol_version >= "HTTP/1.1":
+            if self.request_version == "HTTP/1.1":
+                self.send_header("Transfer-Encoding", "chunked")
+                self.chunked = True
+            else:
+                # The end of the body is marked by closing the connection
+                self.send_header("Connection", "close")
+        self.end_headers()
+        if response.has_body:
+            return response
+        response.close()
+        return None
+
+    def copyfile(self, source, outputfile):
+        """Copy a Response body (bytes or file parts), or a plain file object."""
+        if not isinstance(source, Response):
+            shutil.copyfileobj(source, outputfile, COPY_BUFFER_SIZE)
+            return
+        if source.chunks is not None:
+            for chunk in chunked_encoding(source.chunks) if self.chunked else source.chunks:
+                outputfile.write(chunk)
+            return
+        if source.body:
+            outputfile.write(source.body)
+        for prefix, start, length in source.parts:
+            if prefix:
+                outputfile.write(prefix)
+            if source.buffer is not None:
+                outputfile.write(source.buffer[start:start + length])
+            else:
+                self.copy_range(source.file, outputfile, start, length)
+        if source.trailer:
+            outputfile.write(source.trailer)
+
+    def copy_range(self, source, outputfile, start, length):
+        """
+        Copy length bytes of source starting at offset start. Plain-HTTP
+        connections, and TLS connections the kernel encrypts (kTLS), use
+        sendfile; other TLS sockets need the bytes in user space for
+        encryption, so they get a buffered copy.
+        """
+        if self.use_sendfile and not isinstance(self.connection, ssl.SSLSocket):
+            self.connection.sendfile(source, start, length)
+            return
+        if self.ktls_send:
+            sendfile_all(self.connection, source, start, length)
+            return
+        source.seek(start)
+        while length > 0:
+            chunk = source.read(min(COPY_BUFFER_SIZE, length))
+            if not chunk:
+                break
+            outputfile.write(chunk)
+            length -= len(chunk)
+
+
+class DirectoryHTTPServer(HTTPServer):
+    """HTTPServer base with quiet handling of dropped connections and basic stats."""
+    request_queue_size = 128  # listen() backlog
+
+    def __init__(self, server_address, RequestHandlerClass):
+        super().__init__(server_address, RequestHandlerClass)
+        self.started_at = time.time()
+        self.tls = None
+
+    def get_request(self):
+        """Wrap accepted connections with the current TLS context; the handshake runs in setup()."""
+        request, client_address = super().get_request()
+        if self.tls is not None:
+            request = self.tls.wrap_socket(request, server_side=True, do_handshake_on_connect=False)
+        return request, client_address
+
+    def shutdown_request(self, request):
+        if isinstance(request, ssl.SSLSocket):
+            # Send close_notify (without waiting for the client's): OpenSSL
+            # drops sessions of connections closed without it from its cache
+            try:
+                request.setblocking(False)
+                request.unwrap()
+            except (OSError, ValueError):
+                pass
+        super().shutdown_request(request)
+
+    def handle_error(self, request, client_address):
+        """Client disconnects and failed TLS handshakes are routine; log them briefly."""
+        exc = sys.exc_info()[1]
+        if isinstance(exc, OSError):
+            logger.debug(f"Connection from {client_address[0]} dropped: {exc}")
+            return
+        logger.exception(f"Error handling request from {client_address[0]}")
+
+    def stats(self):
+        stats = {
+            "mode": "base",
+            "uptime_seconds": round(time.time() - self.started_at, 1),
+            "threads": threading.active_count()
+        }
+        if self.tls is not None:
+            stats["tls"] = self.tls.stats()
+        return stats
+
+
+class ThreadedHTTPServer(ThreadingMixIn, DirectoryHTTPServer):
+    """Handle requests in separate threads for concurrent processing."""
+    daemon_threads = True  # Don't wait for threads to finish on shutdown
+
+    def stats(self):
+        return dict(super().stats(), mode="threaded")
+
+
+class PooledHTTPServer(DirectoryHTTPServer):
+    """
+    Handle connections on a fixed number of worker threads.
+
+    Accepted connections wait in a bounded queue until a worker is free; when
+    the queue is full new connections are closed straight away rather than
+    piling up threads and memory. With keep-alive enabled a worker stays with
+    its connection until the client goes idle, so size --workers for the
+    number of simultaneously active devices.
+    """
+
+    def __init__(self, server_address, RequestHandlerClass,
+                 workers=DEFAULT_POOL_WORKERS, queue_size=DEFAULT_POOL_QUEUE_SIZE):
+        super().__init__(server_address, RequestHandlerClass)
+        self.workers = workers
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stats_lock = threading.Lock()
+        self.accepted = 0
+        self.rejected = 0
+        self.served = 0
+        self.busy = 0
+        self.max_queue_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work, name=f"worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def process_request(self, request, client_address):
+        """Queue the connection for a worker, or drop it if the queue is full."""
+        try:
+            self._queue.put_nowait((request, client_address, time.monotonic()))
+        except queue.Full:
+            with self._stats_lock:
+                self.rejected += 1
+            logger.warning(f"Worker queue full, dropping connection from {client_address[0]}")
+            self.shutdown_request(request)
+            return
+        with self._stats_lock:
+            self.accepted += 1
+            self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            request, client_address, queued_at = item
+            wait = time.monotonic() - queued_at
+            with self._stats_lock:
+                self.busy += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                with self._stats_lock:
+                    self.busy -= 1
+                    self.served += 1
+
+    def server_close(self):
+        super().server_close()
+        for _ in self._threads:
+            self._queue.put(None)
+
+    def stats(self):
+        with self._stats_lock:
+            started = self.served + self.busy
+            return dict(
+                super().stats(),
+                mode="pool",
+                workers=self.workers,
+                busy_workers=self.busy,
+                queue_depth=self._queue.qsize(),
+                queue_capacity=self._queue.maxsize,
+                max_queue_depth=self.max_queue_depth,
+                accepted=self.accepted,
+                rejected=self.rejected,
+                served=self.served,
+                avg_wait_ms=round(self.total_wait / started * 1000, 2) if started else 0.0,
+                max_wait_ms=round(self.max_wait * 1000, 2)
+            )
+
+
+class AsyncDirectoryServer:
+    """
+    asyncio serving engine. Holds thousands of idle keep-alive connections
+    on one thread; routing is shared with DirectoryHandler via
+    build_response, which runs on a small executor so blocking Drive FS
+    calls never stall the event loop. File bodies are read in chunks on the
+    executor and written with drain(), so slow clients apply back-pressure
+    instead of buffering whole files in memory.
+    """
+    server_version = DirectoryHandler.server_version
+    sys_version = DirectoryHandler.sys_version
+    # loop.sendfile uses os.sendfile on Unix and TransmitFile on the Windows
+    # proactor loop; TLS transports always get the chunked copy below
+    use_sendfile = True
+
+    def __init__(self, server_address, root, tls=None, workers=DEFAULT_POOL_WORKERS):
+        self.server_address = server_address
+        self.root = root
+        self.tls = tls
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fs")
+        self.workers = workers
+        self.keep_alive = False
+        self.keep_alive_timeout = DEFAULT_KEEP_ALIVE_TIMEOUT_SECONDS
+        self.keep_alive_max = DEFAULT_KEEP_ALIVE_MAX_REQUESTS
+        self.started_at = time.time()
+        self.open_connections = 0
+        self.total_connections = 0
+        self.requests = 0
+
+    def serve_forever(self):
+        asyncio.run(self._serve())
+
+    def server_close(self):
+        self.executor.shutdown(wait=False)
+
+    async def _serve(self):
+        host, port = self.server_address
+        server = await asyncio.start_server(
+            self._handle_connection, host or None, port,
+            backlog=DirectoryHTTPServer.request_queue_size
+        )
+        async with server:
+            await server.serve_forever()
+
+    async def _handle_connection(self, reader, writer):
+        client = writer.get_extra_info("peername") or ("-",)
+        self.open_connections += 1
+        self.total_connections += 1
+        try:
+            if self.tls is not None:
+                # Handshake with the context current now, so renewed
+                # certificates and rotated ticket keys apply to new connections
+                await writer.start_tls(self.tls.context, ssl_handshake_timeout=TLS_HANDSHAKE_TIMEOUT_SECONDS)
+                self.tls.record_handshake(writer.get_extra_info("ssl_object"))
+            handled = 0
+            while True:
+                timeout = self.keep_alive_timeout if handled else REQUEST_READ_TIMEOUT_SECONDS
+                request = await self._read_request(reader, timeout)
+                if request is None:
+                    break
+                keep_open = await self._respond(writer, client, request, handled)
+                handled += 1
+                if not keep_open:
+                    break
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError) as e:
+            logger.debug(f"Connection from {client[0]} dropped: {e}")
+        finally:
+            self.open_connections -= 1
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    async def _read_request(self, reader, timeout):
+        """Read a request line and headers; None when the client closed or went idle."""
+        try:
+            requestline = await asyncio.wait_for(reader.readline(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        if not requestline:
+            return None
+
+        header_lines = []
+        while True:
+            line = await asyncio.wait_for(reader.readline(), REQUEST_READ_TIMEOUT_SECONDS)
+            if line in (b"\r\n", b"\n", b""):
+                break
+            header_lines.append(line)
+            if len(header_lines) > 100:
+                raise ValueError("too many headers")
+        headers = http.client.parse_headers(BytesIO(b"".join(header_lines) + b"\r\n"))
+        return requestline.decode("iso-8859-1").rstrip("\r\n"), headers
+
+    async def _respond(self, writer, client, request, handled):
+        """Answer one request; returns whether the connection may stay open."""
+        requestline, headers = request
+        words = requestline.split()
+        self.requests += 1
+
+        if len(words) != 3 or not words[2].startswith("HTTP/"):
+            response, command, version = error_response(HTTPStatus.BAD_REQUEST), "", "HTTP/1.0"
+        else:
+            command, url, version = words
+            if command in ("GET", "HEAD"):
+                loop = asyncio.get_running_loop()
+                response = await loop.run_in_executor(
+                    self.executor, build_response, self, url, headers, self.root)
+            elif command == "OPTIONS":
+                response = Response(HTTPStatus.OK, [("Content-Length", "0")])
+            else:
+                response = error_response(HTTPStatus.NOT_IMPLEMENTED, f"Unsupported method ({command!r})")
+
+        connection = (headers.get("Connection") or "").lower()
+        keep_open = (
+            self.keep_alive
+            and response.status < 500 and response.status != HTTPStatus.BAD_REQUEST
+            and command in ("GET", "HEAD", "OPTIONS")
+            and not headers.get("Content-Length") and not headers.get("Transfer-Encoding")
+            and connection != "close"
+            and (version == "HTTP/1.1" or connection == "keep-alive")
+        )
+        chunked = False
+        if response.chunks is not None:
+            if keep_open and version == "HTTP/1.1":
+                response.headers.append(("Transfer-Encoding", "chunked"))
+                chunked = True
+            else:
+                # The end of the body is marked by closing the connection
+                keep_open = False
+
+        head = [f"{'HTTP/1.1' if self.keep_alive else 'HTTP/1.0'} {response.status.value} {response.status.phrase}",
+                f"Server: {self.server_version} {self.sys_version}",
+                f"Date: {email.utils.formatdate(usegmt=True)}"]
+        head += [f"{name}: {value}" for name, value in response.headers]
+        if keep_open and handled + 1 >= self.keep_alive_max:
+            keep_open = False
+            head.append("Connection: close")
+        elif keep_open:
+            if version == "HTTP/1.0":
+                head.append("Connection: keep-alive")
+            remaining = self.keep_alive_max - handled - 1
+            head.append(f"Keep-Alive: timeout={int(self.keep_alive_timeout)}, max={remaining}")
+        elif self.keep_alive:
+            head.append("Connection: close")
+        head += [f"{name}: {value}" for name, value in common_headers(words[1] if len(words) > 1 else "/")]
+
+        logger.info(f'{client[0]} - "{requestline}" {response.status.value} -')
+        try:
+            writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1", "strict"))
+            if command != "HEAD":
+                await self._write_body(writer, response, chunked)
+            await writer.drain()
+        finally:
+            response.close()
+        return keep_open
+
+    async def _write_body(self, writer, response, chunked=False):
+        loop = asyncio.get_running_loop()
+        if response.chunks is not None:
+            chunks = response.chunks
+            while True:
+                if hasattr(chunks, "__anext__"):
+                    try:
+                        chunk = await chunks.__anext__()
+                    except StopAsyncIteration:
+                        break
+                else:
+                    # Chunks may read the filesystem, so they're produced on the executor
+                    chunk = await loop.run_in_executor(self.executor, next, chunks, None)
+                    if chunk is None:
+                        break
+                if not chunk:
+                    continue
+                writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk) if chunked else chunk)
+                await writer.drain()
+            if chunked:
+                writer.write(b"0\r\n\r\n")
+            return
+        if response.body:
+            writer.write(response.body)
+        sendfile = self.use_sendfile and writer.get_extra_info("sslcontext") is None
+        for prefix, start, length in response.parts:
+            if prefix:
+                writer.write(prefix)
+            if response.buffer is not None:
+                # Slice the cached file so drain() can pace slow clients
+                for offset in range(start, start + length, HOT_CACHE_WRITE_SIZE):
+                    writer.write(response.buffer[offset:min(offset + HOT_CACHE_WRITE_SIZE, start + length)])
+                    await writer.drain()
+                continue
+            if sendfile:
+                await writer.drain()
+                await loop.sendfile(writer.transport, response.file, start, length)
+                continue
+            offset = start
+            while length > 0:
+                chunk = await loop.run_in_executor(
+                    self.executor, read_at, response.file, offset, min(COPY_BUFFER_SIZE, length))
+                if not chunk:
+                    break
+                writer.write(chunk)
+                await writer.drain()
+                offset += len(chunk)
+                length -= len(chunk)
+        if response.trailer:
+            writer.write(response.trailer)
+
+    def stats(self):
+        stats = {
+            "mode": "asyncio",
+            "uptime_seconds": round(time.time() - self.started_at, 1),
+            "threads": threading.active_count(),
+            "executor_workers": self.workers,
+            "open_connections": self.open_connections,
+            "total_connections": self.total_connections,
+            "requests": self.requests
+        }
+        if self.tls is not None:
+            stats["tls"] = self.tls.stats()
+        return stats
+
+
+def read_at(f, offset, length):
+    """Read length bytes of f from offset (runs on an executor thread)."""
+    f.seek(offset)
+    return f.read(length)
+
+
+def ktls_available(server_mode):
+    """
+    Whether kernel TLS (kTLS) can be requested, so HTTPS file bodies can go
+    through sendfile. Logs which path will be active.
+    """
+    if server_mode == "asyncio":
+        logger.info("kTLS: not available in asyncio mode (asyncio encrypts in user space); "
+                    "HTTPS file bodies use buffered TLS writes")
+        return False
+    if not hasattr(ssl, "OP_ENABLE_KTLS") or not sys.platform.startswith("linux") or not hasattr(os, "sendfile"):
+        logger.info("kTLS: not supported here (needs Linux, Python 3.12+ and OpenSSL built with kTLS); "
+                    "HTTPS file bodies use buffered TLS writes")
+        return False
+    logger.info("kTLS: enabled; HTTPS file bodies use sendfile on connections the kernel accepts, "
+                "buffered TLS writes otherwise")
+    return True
+
+
+class ServerTLS:
+    """
+    Owns the server's SSLContext. Connections are wrapped with whichever
+    context is current when they are accepted (wrap_socket for the threaded
+    engines, StreamWriter.start_tls for asyncio), so replacing it only
+    affects new connections.
+
+    OpenSSL keeps the session cache and generates the session ticket keys
+    per context, in memory. Rebuilding the context every ticket_rotation
+    seconds therefore rotates the ticket keys; a client holding a ticket
+    from before a rotation does one full handshake and gets a new ticket.
+
+    The cert and key files are checked every cert_check seconds, and a
+    renewed certificate is loaded into a new context the same way, without
+    touching the listening socket or connections in progress. If the new
+    files don't load (e.g. renewal is still writing them), the current
+    context stays and the next check tries again.
+    """
+
+    def __init__(self, certfile, keyfile, tickets=True,
+                 ticket_rotation=DEFAULT_TLS_TICKET_ROTATION_SECONDS, ktls=False,
+                 cert_check=DEFAULT_CERT_CHECK_SECONDS):
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.tickets = tickets
+        self.ticket_rotation = ticket_rotation
+        self.ktls = ktls
+        self.cert_check = cert_check
+        self.rotations = 0
+        self.cert_reloads = 0
+        self.handshakes = {"full": 0, "resumed": 0}
+        self.ktls_connections = {"ktls": 0, "userspace": 0}
+        self._lock = threading.Lock()
+        self._cert_state = self._read_cert_state()
+        self._context = self._build()
+        self._built_at = self._checked_at = time.monotonic()
+        self.cert_loaded_at = time.time()
+
+    def _read_cert_state(self):
+        """mtime and size of the cert and key files, or None while one is missing."""
+        try:
+            return tuple((st.st_mtime_ns, st.st_size) for st in (os.stat(self.certfile), os.stat(self.keyfile)))
+        except OSError:
+            return None
+
+    def _build(self):
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile=self.certfile, keyfile=self.keyfile)
+        # TLS 1.3 tickets sent after each full handshake; with tickets off
+        # they carry a session ID for the server-side cache instead
+        context.num_tickets = TLS_TICKETS_PER_HANDSHAKE
+        if not self.tickets:
+            context.options |= ssl.OP_NO_TICKET
+        if self.ktls:
+            context.options |= ssl.OP_ENABLE_KTLS
+        return context
+
+    def _rotation_due(self, now):
+        return self.ticket_rotation > 0 and now - self._built_at >= self.ticket_rotation
+
+    def _cert_check_due(self, now):
+        return self.cert_check > 0 and now - self._checked_at >= self.cert_check
+
+    @property
+    def context(self):
+        """The context for new connections, rebuilt after a certificate renewal or when the ticket keys are due."""
+        now = time.monotonic()
+        if self._rotation_due(now) or self._cert_check_due(now):
+            with self._lock:
+                self._refresh(time.monotonic())
+        return self._context
+
+    def _refresh(self, now):
+        renewed = None
+        if self._cert_check_due(now):
+            self._checked_at = now
+            state = self._read_cert_state()
+            if state is not None and state != self._cert_state:
+                renewed = state
+        if renewed is None and not self._rotation_due(now):
+            return
+        try:
+            context = self._build()
+        except (OSError, ssl.SSLError) as e:
+            if renewed is not None:
+                logger.error(f"Could not load renewed TLS certificate, keeping the current one: {e}")
+            else:
+                logger.error(f"Could not rebuild TLS context, keeping the current one: {e}")
+                self._built_at = now
+            return
+        self._context = context
+        self._built_at = now
+        if renewed is not None:
+            self._cert_state = renewed
+            self.cert_reloads += 1
+            self.cert_loaded_at = time.time()
+            logger.info(f"Loaded renewed TLS certificate from {self.certfile}")
+        else:
+            self.rotations += 1
+            logger.info("Rotated TLS session ticket keys")
+
+    def wrap_socket(self, sock, **kwargs):
+        return self.context.wrap_socket(sock, **kwargs)
+
+    def record_handshake(self, ssl_object, ktls=None):
+        """Count a completed handshake as resumed or full, and its kTLS outcome if kTLS was requested."""
+        with self._lock:
+            self.handshakes["resumed" if ssl_object.session_reused else "full"] += 1
+            first_ktls = ktls is not None and not any(self.ktls_connections.values())
+            if ktls is not None:
+                self.ktls_connections["ktls" if ktls else "userspace"] += 1
+        if first_ktls:
+            if ktls:
+                logger.info("kTLS active: HTTPS file bodies are sent with sendfile")
+            else:
+                logger.info("kTLS not accepted by the kernel for this connection "
+                            "(is the 'tls' kernel module loaded?); using user-space TLS")
+
+    def stats(self):
+        with self._lock:
+            handshakes = self.handshakes["full"] + self.handshakes["resumed"]
+            session_stats = self._context.session_stats()
+            stats = {
+                "session_tickets": self.tickets,
+                "ticket_rotation_seconds": self.ticket_rotation,
+                "rotations": self.rotations,
+                "certificate_reloads": self.cert_reloads,
+                "certificate_loaded_at": datetime.fromtimestamp(self.cert_loaded_at).isoformat(timespec="seconds"),
+                "full_handshakes": self.handshakes["full"],
+                "resumed_handshakes": self.handshakes["resumed"],
+                "resumption_rate": round(self.handshakes["resumed"] / handshakes, 3) if handshakes else 0.0,
+                "session_cache": {key: session_stats[key] for key in ("number", "hits", "misses", "timeouts", "cache_full")}
+            }
+            if self.ktls:
+                stats["ktls_connections"] = dict(self.ktls_connections)
+        return stats
+
+
+def run_server(port=DEFAULT_PORT, directory=None, skip_drive_check=False, certfile=None, keyfile=None,
+               listing_cache_mb=DEFAULT_LISTING_CACHE_MB, listing_max_age=DEFAULT_LISTING_MAX_AGE_SECONDS,
+               keep_alive=False, keep_alive_timeout=DEFAULT_KEEP_ALIVE_TIMEOUT_SECONDS,
+               keep_alive_max=DEFAULT_KEEP_ALIVE_MAX_REQUESTS, server_mode="threaded",
+               workers=DEFAULT_POOL_WORKERS, queue_size=DEFAULT_POOL_QUEUE_SIZE,
+               hot_cache_mb=DEFAULT_HOT_CACHE_MB, hot_cache_max_file_mb=DEFAULT_HOT_CACHE_MAX_FILE_MB,
+               ktls=False, tls_tickets=True, tls_ticket_rotation=DEFAULT_TLS_TICKET_ROTATION_SECONDS,
+               cert_check=DEFAULT_CERT_CHECK_SECONDS, index=False, index_interval=DEFAULT_INDEX_INTERVAL_SECONDS,
+               index_snapshot=INDEX_SNAPSHOT_FILE, gzip_cache_mb=DEFAULT_GZIP_CACHE_MB, gzip_cache_dir=GZIP_CACHE_DIR):
+    if not skip_drive_check:
+        if not wait_for_google_drive():
+            sys.exit(1)
+
+    if directory:
+        os.chdir(directory)
+
+    # Enable HTTPS if certfile is provided
+    protocol = "http"
+    tls = None
+    if certfile:
+        # Clean up paths (remove quotes if passed by shell/batch erroneously)
+        certfile = certfile.strip('"').strip("'")
+        if keyfile:
+            keyfile = keyfile.strip('"').strip("'")
+            
+        if not keyfile:
+            # Assume combined cert/key or key is in certfile
+            keyfile = certfile
+            
+        logger.info(f"Enabling HTTPS using cert: {certfile}")
+
+        if server_mode == "asyncio" and not hasattr(asyncio.StreamWriter, "start_tls"):
+            logger.error("HTTPS with --server-mode asyncio needs Python 3.11 or newer")
+            sys.exit(1)
+
+        if ktls:
+            ktls = ktls_available(server_mode)
+
+        # Create SSL context
+        try:
+            tls = ServerTLS(certfile, keyfile, tickets=tls_tickets,
+                            ticket_rotation=tls_ticket_rotation, ktls=ktls, cert_check=cert_check)
+            protocol = "https"
+        except Exception as e:
+            logger.error(f"Failed to load SSL certificate: {e}")
+            sys.exit(1)
+
+    server_address = ('', port)
+    if server_mode == "asyncio":
+        httpd = AsyncDirectoryServer(server_address, os.getcwd(), tls=tls, workers=workers)
+    else:
+        if server_mode == "pool":
+            httpd = PooledHTTPServer(server_address, DirectoryHandler, workers=workers, queue_size=queue_size)
+        else:
+            httpd = ThreadedHTTPServer(server_address, DirectoryHandler)
+        # Handshakes happen on the worker thread (DirectoryHandler.setup), not in the accept loop
+        httpd.tls = tls
+    if listing_cache_mb > 0:
+        httpd.listing_cache = ListingCache(
+            max_bytes=int(listing_cache_mb * 1024 * 1024),
+            max_age=listing_max_age
+        )
+    if hot_cache_mb > 0:
+        httpd.hot_cache = HotFileCache(
+            max_bytes=int(hot_cache_mb * 1024 * 1024),
+            max_file_bytes=int(hot_cache_max_file_mb * 1024 * 1024)
+        )
+    if gzip_cache_mb > 0:
+        httpd.gzip_cache = GzipFileCache(gzip_cache_dir, max_bytes=int(gzip_cache_mb * 1024 * 1024))
+        httpd.gzip_cache.start()
+    httpd.listing_history = ListingHistory()
+    httpd.batch_pool = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix="batch")
+    if index:
+        httpd.tree_index = TreeIndex(os.getcwd(), interval=index_interval, snapshot=index_snapshot,
+                                     max_age=listing_max_age)
+        # Each stream holds a pool worker, so leave one free for everything else
+        httpd.change_feed = ChangeFeed(httpd.tree_index, max_subscribers=min(
+            MAX_EVENT_SUBSCRIBERS, workers - 1) if server_mode == "pool" else MAX_EVENT_SUBSCRIBERS)
+        httpd.tree_index.start()
+    httpd.keep_alive = keep_alive
+    httpd.keep_alive_timeout = keep_alive_timeout
+    httpd.keep_alive_max = keep_alive_max
     
     logger.info(f"Serving {protocol.upper()} on 0.0.0.0 port {port}")
     logger.info(f"Directory: {os.getcwd()}")
+    if server_mode == "pool":
+        logger.info(f"Worker pool: {workers} workers, queue of {queue_size} connections")
+    elif server_mode == "asyncio":
+        logger.info(f"asyncio event loop, {workers} filesystem worker threads")
+    else:
+        logger.info("Thread per connection")
+    if listing_cache_mb > 0:
+        logger.info(f"Listing cache: {listing_cache_mb} MB, max age {listing_max_age}s")
+    else:
+        logger.info("Listing cache: disabled")
+    if index:
+        logger.info(f"Tree index: building in the background, refreshed every {index_interval:g}s")
+        if index_snapshot is not None:
+            logger.info(f"Tree index snapshot: {index_snapshot}")
+    if hot_cache_mb > 0:
+        logger.info(f"Hot file cache: {hot_cache_mb} MB, files up to {hot_cache_max_file_mb} MB")
+    if gzip_cache_mb > 0:
+        logger.info(f"Compressed file cache: {gzip_cache_mb} MB in {gzip_cache_dir}")
+    if tls is not None:
+        resumption = "session tickets" if tls_tickets else "server session cache"
+        rotation = f"rotated every {tls_ticket_rotation:g}s" if tls_ticket_rotation > 0 else "never rotated"
+        logger.info(f"TLS session resumption: {resumption}, keys {rotation}")
+        if cert_check > 0:
+            logger.info(f"Checking certificate files for renewal every {cert_check:g}s")
+    if keep_alive:
+        logger.info(f"HTTP/1.1 keep-alive: idle timeout {keep_alive_timeout}s, max {keep_alive_max} requests per connection")
     logger.info(f"Open {protocol}://localhost:{port} in your browser")
     logger.info("Press Ctrl+C to stop the server")
     
@@ -281,7 +3591,11 @@ def run_server(port=DEFAULT_PORT, directory=None, skip_drive_check=False, certfi
         httpd.serve_forever()
     except KeyboardInterrupt:
         logger.info("Server stopped by user.")
-        httpd.shutdown()
+        logger.info(f"Server stats: {httpd.stats()}")
+        tree_index = getattr(httpd, "tree_index", None)
+        if tree_index is not None and tree_index.ready and tree_index.snapshot is not None:
+            tree_index.save(tree_index.snapshot)
+        httpd.server_close()
 
 
 def main():
@@ -297,6 +3611,47 @@ def main():
                         help='Path to SSL certificate file (PEM format) to enable HTTPS')
     parser.add_argument('--key', type=str, default=None,
                         help='Path to SSL private key file (PEM format). Defaults to matching cert file if not specified.')
+    parser.add_argument('--listing-cache-mb', type=float, default=DEFAULT_LISTING_CACHE_MB,
+                        help=f'Memory budget for cached directory listings in MB, 0 to disable (default: {DEFAULT_LISTING_CACHE_MB})')
+    parser.add_argument('--listing-max-age', type=float, default=DEFAULT_LISTING_MAX_AGE_SECONDS,
+                        help=f'Re-read a cached directory after this many seconds even if its mtime is unchanged (default: {DEFAULT_LISTING_MAX_AGE_SECONDS})')
+    parser.add_argument('--keep-alive', action='store_true',
+                        help='Use HTTP/1.1 persistent connections so clients can reuse TCP/TLS connections')
+    parser.add_argument('--keep-alive-timeout', type=float, default=DEFAULT_KEEP_ALIVE_TIMEOUT_SECONDS,
+                        help=f'Seconds an idle persistent connection is kept open (default: {DEFAULT_KEEP_ALIVE_TIMEOUT_SECONDS})')
+    parser.add_argument('--keep-alive-max', type=int, default=DEFAULT_KEEP_ALIVE_MAX_REQUESTS,
+                        help=f'Requests served on one connection before it is closed (default: {DEFAULT_KEEP_ALIVE_MAX_REQUESTS})')
+    parser.add_argument('--server-mode', choices=['threaded', 'pool', 'asyncio'], default='threaded',
+                        help='threaded: one thread per connection; pool: fixed worker pool with a bounded queue; '
+                             'asyncio: single event loop for many idle keep-alive clients (default: threaded)')
+    parser.add_argument('--workers', type=int, default=DEFAULT_POOL_WORKERS,
+                        help=f'Worker threads in pool mode, or filesystem threads in asyncio mode (default: {DEFAULT_POOL_WORKERS})')
+    parser.add_argument('--queue-size', type=int, default=DEFAULT_POOL_QUEUE_SIZE,
+                        help=f'Connections that may wait for a worker in pool mode before new ones are dropped (default: {DEFAULT_POOL_QUEUE_SIZE})')
+    parser.add_argument('--hot-cache-mb', type=float, default=DEFAULT_HOT_CACHE_MB,
+                        help='Memory budget in MB for keeping popular files in RAM, 0 to disable (default: 0)')
+    parser.add_argument('--hot-cache-max-file-mb', type=float, default=DEFAULT_HOT_CACHE_MAX_FILE_MB,
+                        help=f'Largest file kept in the hot file cache, in MB (default: {DEFAULT_HOT_CACHE_MAX_FILE_MB})')
+    parser.add_argument('--gzip-cache-mb', type=float, default=DEFAULT_GZIP_CACHE_MB,
+                        help='Local disk budget in MB for gzip-compressed copies of PDF, SVG, HTML, JSON and subtitle files, 0 to disable (default: 0)')
+    parser.add_argument('--gzip-cache-dir', type=str, default=str(GZIP_CACHE_DIR),
+                        help=f'Folder for the compressed copies; keep it off Google Drive (default: {GZIP_CACHE_DIR})')
+    parser.add_argument('--ktls', action='store_true',
+                        help='Use kernel TLS (Linux, Python 3.12+) so HTTPS downloads can use sendfile; falls back automatically')
+    parser.add_argument('--no-tls-tickets', action='store_true',
+                        help='Resume TLS sessions from the server-side session cache instead of session tickets')
+    parser.add_argument('--tls-ticket-rotation', type=float, default=DEFAULT_TLS_TICKET_ROTATION_SECONDS,
+                        help=f'Seconds between TLS session ticket key rotations, 0 to never rotate (default: {DEFAULT_TLS_TICKET_ROTATION_SECONDS})')
+    parser.add_argument('--cert-check-interval', type=float, default=DEFAULT_CERT_CHECK_SECONDS,
+                        help=f'Seconds between checks of the cert/key files for a renewed certificate, 0 to disable (default: {DEFAULT_CERT_CHECK_SECONDS})')
+    parser.add_argument('--index', action='store_true',
+                        help='Keep an in-memory index of the whole content tree, built in the background, and answer listings from it')
+    parser.add_argument('--index-interval', type=float, default=DEFAULT_INDEX_INTERVAL_SECONDS,
+                        help=f'Seconds between incremental index refreshes (default: {DEFAULT_INDEX_INTERVAL_SECONDS})')
+    parser.add_argument('--index-snapshot', type=str, default=str(INDEX_SNAPSHOT_FILE),
+                        help=f'File the tree index is saved to and loaded from at startup (default: {INDEX_SNAPSHOT_FILE})')
+    parser.add_argument('--no-index-snapshot', action='store_true',
+                        help='Always build the tree index by walking the content folder')
     args = parser.parse_args()
     
     run_server(
@@ -304,7 +3659,26 @@ def main():
         directory=args.directory, 
         skip_drive_check=args.skip_drive_check,
         certfile=args.cert,
-        keyfile=args.key
+        keyfile=args.key,
+        listing_cache_mb=args.listing_cache_mb,
+        listing_max_age=args.listing_max_age,
+        keep_alive=args.keep_alive,
+        keep_alive_timeout=args.keep_alive_timeout,
+        keep_alive_max=args.keep_alive_max,
+        server_mode=args.server_mode,
+        workers=args.workers,
+        queue_size=args.queue_size,
+        hot_cache_mb=args.hot_cache_mb,
+        hot_cache_max_file_mb=args.hot_cache_max_file_mb,
+        ktls=args.ktls,
+        tls_tickets=not args.no_tls_tickets,
+        tls_ticket_rotation=args.tls_ticket_rotation,
+        cert_check=args.cert_check_interval,
+        index=args.index,
+        index_interval=args.index_interval,
+        index_snapshot=None if args.no_index_snapshot else args.index_snapshot,
+        gzip_cache_mb=args.gzip_cache_mb,
+        gzip_cache_dir=args.gzip_cache_dir
     )
 
 
@@ -88,6 +88,7 @@ REM Copy files
 echo Copying files...
 copy /Y "%~dp0directory_server.py" "%INSTALL_DIR%\" >nul
 copy /Y "%~dp0load_test.py" "%INSTALL_DIR%\" >nul
+copy /Y "%~dp0benchmark.py" "%INSTALL_DIR%\" >nul
 copy /Y "%~dp0README.md" "%INSTALL_DIR%\" >nul
 if exist "%~dp0nssm.exe" copy /Y "%~dp0nssm.exe" "%INSTALL_DIR%\" >nul
 
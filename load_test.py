@@ -7,14 +7,70 @@ Tests concurrent request handling capability.
 import argparse
 import time
 import statistics
+import threading
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib.request import urlopen, Request
 from urllib.error import URLError
+from urllib.parse import urlsplit
+from http.client import HTTPConnection, HTTPSConnection
 import ssl
 import json
 
 
-def make_request(url: str, timeout: int = 10) -> dict:
+def make_ssl_context() -> ssl.SSLContext:
+    """SSL context that doesn't verify (for self-signed certs in testing)."""
+    ctx = ssl.create_default_context()
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE
+    return ctx
+
+
+class ConnectionPool:
+    """One persistent HTTP/1.1 connection per worker thread, for keep-alive runs."""
+
+    def __init__(self, url: str, timeout: int):
+        parts = urlsplit(url)
+        self.https = parts.scheme == "https"
+        self.host = parts.hostname
+        self.port = parts.port or (443 if self.https else 80)
+        self.path = parts.path or "/"
+        if parts.query:
+            self.path += "?" + parts.query
+        self.timeout = timeout
+        self.opened = 0
+        self._local = threading.local()
+        self._all = []
+        self._lock = threading.Lock()
+
+    def get(self) -> tuple:
+        """Return (connection, is_new) for the calling thread."""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            return conn, False
+        if self.https:
+            conn = HTTPSConnection(self.host, self.port, timeout=self.timeout, context=make_ssl_context())
+        else:
+            conn = HTTPConnection(self.host, self.port, timeout=self.timeout)
+        self._local.conn = conn
+        with self._lock:
+            self.opened += 1
+            self._all.append(conn)
+        return conn, True
+
+    def discard(self) -> None:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def close_all(self) -> None:
+        with self._lock:
+            for conn in self._all:
+                conn.close()
+            self._all.clear()
+
+
+def make_request(url: str, timeout: int = 10, pool: ConnectionPool = None) -> dict:
     """Make a single request and return timing info."""
     start = time.perf_counter()
     result = {
@@ -26,18 +82,30 @@ def make_request(url: str, timeout: int = 10) -> dict:
     }
 
     try:
-        # Create SSL context that doesn't verify (for self-signed certs in testing)
-        ctx = ssl.create_default_context()
-        ctx.check_hostname = False
-        ctx.verify_mode = ssl.CERT_NONE
-
-        req = Request(url, headers={"Accept": "application/json"})
-        with urlopen(req, timeout=timeout, context=ctx) as response:
+        if pool is not None:
+            conn, _ = pool.get()
+            try:
+                conn.request("GET", pool.path, headers={"Accept": "application/json"})
+                response = conn.getresponse()
+                body = response.read()
+            except Exception:
+                pool.discard()
+                raise
+            if response.will_close:
+                pool.discard()
             result["status"] = response.status
             if response.status == 200:
-                data = json.loads(response.read().decode())
+                data = json.loads(body.decode())
                 result["items"] = data.get("total_items", 0)
                 result["success"] = True
+        else:
+            req = Request(url, headers={"Accept": "application/json"})
+            with urlopen(req, timeout=timeout, context=make_ssl_context()) as response:
+                result["status"] = response.status
+                if response.status == 200:
+                    data = json.loads(response.read().decode())
+                    result["items"] = data.get("total_items", 0)
+                    result["success"] = True
     except URLError as e:
         result["error"] = str(e.reason)
     except Exception as e:
@@ -47,18 +115,20 @@ def make_request(url: str, timeout: int = 10) -> dict:
     return result
 
 
-def run_load_test(url: str, num_requests: int, concurrency: int, timeout: int) -> dict:
+def run_load_test(url: str, num_requests: int, concurrency: int, timeout: int, keep_alive: bool = False) -> dict:
     """Run load test with specified parameters."""
     print(f"\n{'='*60}")
     print(f"Load Test: {url}")
-    print(f"Requests: {num_requests} | Concurrency: {concurrency} | Timeout: {timeout}s")
+    print(f"Requests: {num_requests} | Concurrency: {concurrency} | Timeout: {timeout}s"
+          f" | Keep-alive: {'on' if keep_alive else 'off'}")
     print(f"{'='*60}\n")
 
     results = []
+    pool = ConnectionPool(url, timeout) if keep_alive else None
     start_time = time.perf_counter()
 
     with ThreadPoolExecutor(max_workers=concurrency) as executor:
-        futures = [executor.submit(make_request, url, timeout) for _ in range(num_requests)]
+        futures = [executor.submit(make_request, url, timeout, pool) for _ in range(num_requests)]
 
         completed = 0
         for future in as_completed(futures):
@@ -72,6 +142,8 @@ def run_load_test(url: str, num_requests: int, concurrency: int, timeout: int) -
                 print(f"Progress: {completed}/{num_requests} | Success: {success_count}", end="\r")
 
     total_time = time.perf_counter() - start_time
+    if pool is not None:
+        pool.close_all()
 
     # Calculate statistics
     successful = [r for r in results if r["success"]]
@@ -85,6 +157,7 @@ def run_load_test(url: str, num_requests: int, concurrency: int, timeout: int) -
         "success_rate": len(successful) / num_requests * 100 if num_requests > 0 else 0,
         "total_time_sec": round(total_time, 2),
         "requests_per_sec": round(num_requests / total_time, 2) if total_time > 0 else 0,
+        "connections_opened": pool.opened if pool is not None else num_requests,
     }
 
     if durations:
@@ -106,6 +179,7 @@ def run_load_test(url: str, num_requests: int, concurrency: int, timeout: int) -
     print(f"Success Rate:       {stats['success_rate']:.1f}%")
     print(f"Total Time:         {stats['total_time_sec']}s")
     print(f"Requests/sec:       {stats['requests_per_sec']}")
+    print(f"Connections Opened: {stats['connections_opened']}")
 
     if durations:
         print(f"\nResponse Times:")
@@ -129,6 +203,29 @@ def run_load_test(url: str, num_requests: int, concurrency: int, timeout: int) -
     return stats
 
 
+def compare_keep_alive(url: str, num_requests: int, concurrency: int, timeout: int) -> None:
+    """Run the same load with and without persistent connections and compare."""
+    closed = run_load_test(url, num_requests, concurrency, timeout, keep_alive=False)
+    reused = run_load_test(url, num_requests, concurrency, timeout, keep_alive=True)
+
+    print(f"{'='*60}")
+    print("KEEP-ALIVE COMPARISON")
+    print(f"{'='*60}")
+    print(f"{'':<20}{'New conn/request':>18}{'Keep-alive':>14}")
+    for key, label in [("connections_opened", "Connections"),
+                       ("requests_per_sec", "Requests/sec"),
+                       ("avg_response_ms", "Average (ms)"),
+                       ("median_response_ms", "Median (ms)"),
+                       ("p95_response_ms", "95th pct (ms)")]:
+        if key in closed and key in reused:
+            print(f"{label:<20}{closed[key]:>18}{reused[key]:>14}")
+    if closed.get("avg_response_ms") and reused.get("avg_response_ms"):
+        saved = closed["avg_response_ms"] - reused["avg_response_ms"]
+        print(f"\nHandshake saving:   {saved:.2f}ms per request "
+              f"({saved / closed['avg_response_ms'] * 100:.1f}% of average response time)")
+    print(f"{'='*60}\n")
+
+
 def main():
     parser = argparse.ArgumentParser(description="Load test for Local Directory Server")
     parser.add_argument("url", nargs="?", default="https://localhost:8050/",
@@ -143,6 +240,10 @@ def main():
                         help="Quick test: 20 requests, 5 concurrent")
     parser.add_argument("--stress", action="store_true",
                         help="Stress test: 500 requests, 50 concurrent")
+    parser.add_argument("-k", "--keep-alive", action="store_true",
+                        help="Reuse one HTTP/1.1 connection per worker (server needs --keep-alive)")
+    parser.add_argument("--compare-keep-alive", action="store_true",
+                        help="Run with and without persistent connections and compare")
 
     args = parser.parse_args()
 
@@ -153,7 +254,10 @@ def main():
         args.requests = 500
         args.concurrency = 50
 
-    run_load_test(args.url, args.requests, args.concurrency, args.timeout)
+    if args.compare_keep_alive:
+        compare_keep_alive(args.url, args.requests, args.concurrency, args.timeout)
+    else:
+        run_load_test(args.url, args.requests, args.concurrency, args.timeout, args.keep_alive)
 
 
 if __name__ == "__main__":